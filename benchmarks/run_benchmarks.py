@@ -0,0 +1,298 @@
+
+"""
+Times the puppetcrust hot paths on synthetic data and saves the results as JSON.
+
+Each scenario is run -repeat times for wall and CPU time and once more under tracemalloc for its
+peak Python (and NumPy) memory, so the memory tracking doesn't slow down the timed runs. Results
+from different versions can be compared with compare_results.
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic
+from puppetcrust.trait_table import TraitTableManager
+from puppetcrust.database import DatabaseManager
+from puppetcrust.executer import PicrustExecuter
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+# genomes, traits (KOs), OTU table samples
+SCALES = {
+        "small": {"genomes": 500, "traits": 1000, "samples": 20},
+        "medium": {"genomes": 2000, "traits": 4000, "samples": 50},
+        "large": {"genomes": 7000, "traits": 7000, "samples": 100}
+        }
+
+
+def _load_script(name):
+    """ Imports one of the scripts in scripts/ as a module """
+    path = os.path.join(ROOT_DIR, "scripts", name + ".py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+class Dataset(object):
+    """ Writes a full set of synthetic inputs to data_dir """
+
+    def __init__(self, data_dir, genomes, traits, samples, density=0.1, seed=0):
+        self.data_dir = data_dir
+        self.genomes = genomes
+        self.traits = traits
+        self.samples = samples
+        self.density = density
+        self.seed = seed
+
+        self.names = synthetic.genome_names(genomes)
+
+        self.trait_table_f = os.path.join(data_dir, "traits.tab")
+        self.predicted_f = os.path.join(data_dir, "predicted_traits.tab")
+        self.fasta_fs = [os.path.join(data_dir, "markers1.fasta"), os.path.join(data_dir, "markers2.fasta")]
+        self.otu_table_f = os.path.join(data_dir, "otu_table.tab")
+        self.ko_metadata_f = os.path.join(data_dir, "ko_metadata.tab")
+        self.tree_f = os.path.join(data_dir, "tree.newick")
+
+    def write(self):
+        start = time.time()
+
+        synthetic.write_trait_table(self.trait_table_f, self.genomes, self.traits, self.density, seed=self.seed)
+        synthetic.write_trait_table(self.predicted_f, self.genomes, self.traits, self.density, seed=self.seed + 1, nsti=False, fraction=True)
+
+        # the FASTA files overlap by a tenth of the genomes so there are duplicates to skip
+        half = self.genomes // 2
+        overlap = self.genomes // 10
+        synthetic.write_marker_fasta(self.fasta_fs[0], self.names[:half + overlap], seed=self.seed)
+        synthetic.write_marker_fasta(self.fasta_fs[1], self.names[half:], seed=self.seed + 1)
+
+        # some OTUs have no traits and are filtered out
+        otus = self.names + ["otu{}".format(indx) for indx in range(self.genomes // 10)]
+        synthetic.write_otu_table(self.otu_table_f, otus, self.samples, seed=self.seed)
+
+        synthetic.write_ko_metadata(self.ko_metadata_f, self.traits, seed=self.seed)
+        synthetic.write_newick(self.tree_f, self.names, seed=self.seed)
+
+        LOG.info("Wrote synthetic data to '{}' in {:.1f}s.".format(self.data_dir, time.time() - start))
+
+    def subset(self, fraction=0.1):
+        """ Returns every nth genome name so that about fraction of them are picked """
+        return self.names[::max(1, int(1 / fraction))]
+
+
+def make_scenarios(data, work_dir):
+    """ Returns a list of (name, function) for each scenario. Functions write any output under work_dir """
+    collapse = _load_script("collapse_ko_by_function")
+    kfolds = _load_script("run_kfolds_evaluator")
+
+    subset = data.subset()
+
+    def out(name):
+        return os.path.join(work_dir, name)
+
+    def iterate():
+        return sum(1 for entry in TraitTableManager(data.trait_table_f))
+
+    def load():
+        return len(TraitTableManager(data.trait_table_f).load())
+
+    def compare(metric):
+        def run():
+            return len(TraitTableManager.compare_two_tables(data.trait_table_f, data.predicted_f, metric=metric))
+        return run
+
+    def get_subset():
+        return sum(1 for entry in TraitTableManager(data.trait_table_f).get_subset(subset))
+
+    def write_subset():
+        return len(TraitTableManager(data.trait_table_f).write_subset(out("subset.tab"), subset, remove=True))
+
+    def generate_database():
+        dbm = DatabaseManager()
+        for fasta_f in data.fasta_fs:
+            dbm.add_fasta(fasta_f)
+        dbm.add_trait_table(data.trait_table_f)
+
+        dbm.generate_database(out("database"), subset=subset, inverse=True)
+
+    def filter_otus():
+        PicrustExecuter._filter_otus(data.otu_table_f, data.trait_table_f, out("filtered_otu_table.tab"))
+
+    def collapse_kos():
+        hierarchy = collapse.KOHierarchy.load(data.ko_metadata_f, persist=False)
+        ko_to_functions = {level: hierarchy.ko_to_pathways(level) for level in (1, 2, 3)}
+
+        collapse.collapse_kos(data.trait_table_f, ko_to_functions, "cols", collapse.level_paths(out("collapsed.tab"), [1, 2, 3]))
+
+    def kfold_partitions():
+        # partitions are reloaded from an existing directory, so start fresh each time
+        kfold_dir = out("kfolds")
+        if os.path.isdir(kfold_dir):
+            shutil.rmtree(kfold_dir)
+
+        kfolder = kfolds.KFolder(data.tree_f, data.trait_table_f, kfold_dir, defer_jobs=True)
+        kfolder.make_partitions(k=10, seed=data.seed)
+        return len(kfolder.partitions)
+
+    return [
+            ("trait_table_iterate", iterate),
+            ("trait_table_load", load),
+            ("compare_two_tables_disimilarity", compare("disimilarity")),
+            ("compare_two_tables_spearman", compare("spearman")),
+            ("get_subset", get_subset),
+            ("write_subset_remove", write_subset),
+            ("generate_database", generate_database),
+            ("filter_otus", filter_otus),
+            ("collapse_kos_all_levels", collapse_kos),
+            ("kfold_partitions", kfold_partitions)
+            ]
+
+
+def measure(func, repeat):
+    """ Returns a dict of the wall and CPU times (seconds) of repeat runs of func and the peak traced memory (MB) of one more """
+    walls = []
+    cpus = []
+    for _ in range(repeat):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        func()
+        cpus.append(time.process_time() - cpu)
+        walls.append(time.perf_counter() - wall)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"wall": walls, "cpu": cpus, "best_wall": min(walls), "best_cpu": min(cpus), "peak_mb": peak / 1024 ** 2}
+
+
+def _revision():
+    """ Returns the git revision of the tree being benchmarked or None """
+    try:
+        return subprocess.check_output(["git", "-C", ROOT_DIR, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _versions():
+    versions = {"python": platform.python_version()}
+    for module in ("numpy", "pandas", "scipy"):
+        try:
+            versions[module] = importlib.import_module(module).__version__
+        except ImportError:
+            versions[module] = None
+
+    return versions
+
+
+def run(args):
+    scale = dict(SCALES[args.scale])
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="puppetcrust_bench")
+    data_dir = os.path.join(work_dir, "data")
+    out_dir = os.path.join(work_dir, "out")
+    for path in (data_dir, out_dir):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    data = Dataset(data_dir, scale["genomes"], scale["traits"], scale["samples"], args.density, args.seed)
+    data.write()
+
+    results = {
+            "revision": _revision(),
+            "versions": _versions(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "scale": scale,
+            "density": args.density,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "scenarios": {}
+            }
+
+    for name, func in make_scenarios(data, out_dir):
+        if args.scenarios and name not in args.scenarios:
+            continue
+
+        LOG.info("Running {}...".format(name))
+        results["scenarios"][name] = measure(func, args.repeat)
+        print("{:<35}{:>10.3f}s wall{:>10.3f}s cpu{:>10.1f}MB peak".format(
+            name, results["scenarios"][name]["best_wall"], results["scenarios"][name]["best_cpu"], results["scenarios"][name]["peak_mb"]))
+
+    with open(args.out, 'w') as OUT:
+        json.dump(results, OUT, indent=2, sort_keys=True)
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir)
+
+    return results
+
+
+def compare_results(old_f, new_f):
+    """ Prints the change in best wall time and peak memory of each scenario between two result files """
+    with open(old_f, 'r') as IN:
+        old = json.load(IN)
+    with open(new_f, 'r') as IN:
+        new = json.load(IN)
+
+    if old["scale"] != new["scale"] or old["seed"] != new["seed"]:
+        LOG.warning("The results are from different scales or seeds.")
+
+    print("{:<35}{:>12}{:>12}{:>10}{:>12}{:>12}".format("scenario", "old wall", "new wall", "speedup", "old MB", "new MB"))
+    for name in sorted(set(old["scenarios"]) & set(new["scenarios"])):
+        o = old["scenarios"][name]
+        n = new["scenarios"][name]
+        print("{:<35}{:>12.3f}{:>12.3f}{:>9.2f}x{:>12.1f}{:>12.1f}".format(
+            name, o["best_wall"], n["best_wall"], o["best_wall"] / n["best_wall"], o["peak_mb"], n["peak_mb"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks puppetcrust on synthetic data and writes the timings and peak memory of each scenario as JSON")
+    parser.add_argument("-scale", help="size of the synthetic data [%(default)s]", choices=sorted(SCALES), default="small")
+    parser.add_argument("-genomes", help="override the number of genomes of the scale", type=int, default=None)
+    parser.add_argument("-traits", help="override the number of traits (KOs) of the scale", type=int, default=None)
+    parser.add_argument("-samples", help="override the number of OTU table samples of the scale", type=int, default=None)
+    parser.add_argument("-density", help="fraction of trait values that aren't zero [%(default)s]", type=float, default=0.1)
+    parser.add_argument("-seed", help="random seed for the synthetic data [%(default)s]", type=int, default=0)
+    parser.add_argument("-repeat", help="number of timed runs of each scenario [%(default)s]", type=int, default=3)
+    parser.add_argument("-scenarios", help="only run these scenarios", nargs="+", default=None)
+    parser.add_argument("-work_dir", help="keep the data and outputs here instead of a temporary directory", default=None)
+    parser.add_argument("-out", help="path for the JSON results [%(default)s]", default="benchmark_results.json")
+    parser.add_argument("-compare", help="instead of running, compare two JSON result files (old new)", nargs=2, default=None)
+    parser.add_argument("-verbose", help="show the warnings the scenarios log (duplicate headers, unknown KOs...)", action="store_true")
+
+    args = parser.parse_args()
+
+    LOG.setLevel(logging.INFO)
+    if not args.verbose:
+        for name in ("puppetcrust", "collapse_ko_by_function", "run_kfolds_evaluator"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+    if args.compare:
+        compare_results(*args.compare)
+    else:
+        run(args)
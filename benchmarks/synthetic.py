@@ -0,0 +1,114 @@
+
+"""
+Generators for synthetic PICRUSt inputs at any scale.
+
+Everything is made from a seeded random.Random so the same arguments always write the same files.
+Genomes are named g0, g1, ... and KOs K00000, K00001, ... so the files line up with each other.
+"""
+
+import random
+
+
+def genome_names(genomes):
+    return ["g{}".format(indx) for indx in range(genomes)]
+
+
+def ko_names(kos):
+    return ["K{:05d}".format(indx) for indx in range(kos)]
+
+
+def write_trait_table(path, genomes, traits, density=0.1, max_count=5, seed=0, nsti=True, fraction=False):
+    """
+    Writes a trait table of genomes x traits (KOs) where about density of the cells aren't zero.
+
+    Counts are integers up to max_count unless fraction is True. A metadata_NSTI column is added if nsti is True.
+    """
+    rng = random.Random(seed)
+
+    with open(path, 'w') as OUT:
+        headers = ["genome"] + ko_names(traits)
+        if nsti:
+            headers.append("metadata_NSTI")
+
+        OUT.write("\t".join(headers) + "\n")
+
+        for name in genome_names(genomes):
+            row = [name]
+            for trait in range(traits):
+                if rng.random() < density:
+                    if fraction:
+                        row.append(str(round(rng.uniform(0, max_count), 3)))
+                    else:
+                        row.append(str(rng.randint(1, max_count)))
+                else:
+                    row.append("0")
+
+            if nsti:
+                row.append(str(round(rng.random(), 4)))
+
+            OUT.write("\t".join(row) + "\n")
+
+
+def write_marker_fasta(path, names, length=1500, width=60, seed=0):
+    """ Writes a marker FASTA with a random sequence of about length bases for each name, wrapped at width """
+    rng = random.Random(seed)
+
+    with open(path, 'w') as OUT:
+        for name in names:
+            size = rng.randint(int(length * 0.9), int(length * 1.1))
+            seq = "".join(rng.choice("ACGT") for _ in range(size))
+
+            OUT.write(">{} synthetic marker\n".format(name))
+            for start in range(0, len(seq), width):
+                OUT.write(seq[start:start + width] + "\n")
+
+
+def write_otu_table(path, otus, samples, density=0.3, max_count=100, seed=0):
+    """ Writes a tab delimited OTU table (like 'biom convert --to-tsv' makes) of the named otus x samples """
+    rng = random.Random(seed)
+
+    with open(path, 'w') as OUT:
+        OUT.write("# Constructed from biom file\n")
+        OUT.write("\t".join(["#OTU ID"] + ["S{}".format(indx) for indx in range(samples)]) + "\n")
+
+        for otu in otus:
+            counts = [str(float(rng.randint(1, max_count))) if rng.random() < density else "0.0" for _ in range(samples)]
+            OUT.write("\t".join([otu] + counts) + "\n")
+
+
+def write_ko_metadata(path, kos, top=6, middle=5, pathways=8, max_pathways=3, seed=0):
+    """
+    Writes a KO metadata file (header, then ko, description and '|' separated 'lvl1;lvl2;lvl3' pathways).
+
+    There are top level 1 categories with middle level 2 categories each and pathways level 3 pathways
+    in each of those. Each KO is in 1 to max_pathways pathways.
+    """
+    rng = random.Random(seed)
+
+    with open(path, 'w') as OUT:
+        OUT.write("KEGG_ID\tKEGG_Description\tKEGG_Pathways\n")
+
+        for ko in ko_names(kos):
+            paths = []
+            for _ in range(rng.randint(1, max_pathways)):
+                lvl1 = rng.randrange(top)
+                lvl2 = rng.randrange(middle)
+                lvl3 = rng.randrange(pathways)
+                paths.append("Category {};Subcategory {}.{};Pathway {}.{}.{}".format(lvl1, lvl1, lvl2, lvl1, lvl2, lvl3))
+
+            OUT.write("\t".join([ko, "synthetic KO {}".format(ko), "|".join(paths)]) + "\n")
+
+
+def write_newick(path, names, seed=0):
+    """ Writes a random binary Newick tree with the named tips and random branch lengths """
+    rng = random.Random(seed)
+
+    nodes = ["{}:{:.4f}".format(name, rng.random()) for name in names]
+    while len(nodes) > 1:
+        first = nodes.pop(rng.randrange(len(nodes)))
+        second = nodes.pop(rng.randrange(len(nodes)))
+        nodes.append("({},{}):{:.4f}".format(first, second, rng.random()))
+
+    with open(path, 'w') as OUT:
+        # the root doesn't get a branch length
+        OUT.write(nodes[0].rsplit(":", 1)[0] + ";\n")
@@ -0,0 +1,195 @@
+
+import json
+import logging
+import sqlite3
+
+from puppetcrust.trait_table import TraitTableManager, NonNumericTraitError, iter_row_lists
+from puppetcrust.fasta import read_fasta
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+class GenomeCatalog(object):
+    """
+    A SQLite catalog of the marker sequences, traits and metadata of many genomes.
+
+    Genomes are ingested once and custom databases are then built with indexed queries on the genome
+    names instead of scanning every FASTA and trait table again. Like DatabaseManager, the first
+    record seen for a genome is kept and later duplicates are skipped with a warning.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS traits (position INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+        CREATE TABLE IF NOT EXISTS markers (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, record BLOB NOT NULL);
+        CREATE TABLE IF NOT EXISTS trait_rows (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, row TEXT NOT NULL, metadata TEXT);
+        """
+
+    def __init__(self, catalog_f):
+        self.catalog_f = catalog_f
+
+        self.conn = sqlite3.connect(catalog_f)
+        self.conn.executescript(self.schema)
+
+    def close(self):
+        self.conn.close()
+
+    @property
+    def traits(self):
+        """ The header of the catalog's trait table (from the first table ingested) """
+        return [row[0] for row in self.conn.execute("SELECT name FROM traits ORDER BY position")]
+
+    def __len__(self):
+        """ The number of genomes with both a marker and traits """
+        return self.conn.execute("SELECT COUNT(*) FROM markers JOIN trait_rows USING (name)").fetchone()[0]
+
+    def __contains__(self, name):
+        return self.conn.execute("SELECT 1 FROM markers JOIN trait_rows USING (name) WHERE name = ?", (name,)).fetchone() is not None
+
+    def add_fasta(self, fasta_f):
+        """ Adds the records in a marker FASTA. Returns the number of genomes added """
+        added = 0
+        skipped = 0
+        with self.conn:
+            for name, record in read_fasta(fasta_f):
+                before = self.conn.total_changes
+                self.conn.execute("INSERT OR IGNORE INTO markers (name, record) VALUES (?, ?)", (name, sqlite3.Binary(record)))
+
+                if self.conn.total_changes == before:
+                    skipped += 1
+                else:
+                    added += 1
+
+        if skipped:
+            LOG.warning("{} headers from '{}' were already in the catalog and were skipped.".format(skipped, fasta_f))
+
+        return added
+
+    def add_trait_table(self, table_f, cache=False):
+        """ Adds the entries in a trait table. Returns the number of genomes added """
+        ttm = TraitTableManager(table_f, cache=cache)
+
+        with self.conn:
+            traits = self.traits
+
+            # the first table sets the columns of the catalog
+            if not traits:
+                traits = ttm.traits
+                self.conn.executemany("INSERT INTO traits (position, name) VALUES (?, ?)", enumerate(traits))
+            elif set(traits) != set(ttm.traits):
+                LOG.warning("Traits from '{}' don't match the traits in the catalog. Traits from the catalog will be used.".format(table_f))
+
+            # rows are stored already formatted (like write_rows), in the order of the catalog's traits
+            positions = {trait: indx for indx, trait in enumerate(ttm.value_traits)}
+            wanted = [trait for trait in traits if not trait.startswith("metadata_")]
+            columns = [positions[trait] for trait in wanted if trait in positions]
+            if len(columns) != len(wanted):
+                LOG.warning("Some traits in the catalog aren't in '{}' and won't be stored for its entries.".format(table_f))
+
+            added = 0
+            skipped = 0
+
+            # rows already handled by the blocks, which the entries skip if a block can't be parsed
+            done = 0
+            try:
+                for block in ttm.iter_blocks(rows=10000):
+                    for indx, (name, values) in enumerate(zip(block.names, iter_row_lists(block.values[:, columns]))):
+                        row = "\t".join(str(value) for value in values)
+                        metadata = {key: _json_value(column[indx]) for key, column in block.metadata.items()}
+                        added, skipped = self._add_trait_row(name, row, metadata, added, skipped)
+                        done += 1
+
+            except NonNumericTraitError:
+                LOG.info("'{}' has non-numeric traits. Adding it entry by entry.".format(table_f))
+
+                for indx, entry in enumerate(ttm):
+                    if indx < done:
+                        continue
+
+                    row = "\t".join(str(entry.traits[trait]) for trait in wanted if trait in entry.traits)
+                    added, skipped = self._add_trait_row(entry.name, row, entry.metadata, added, skipped)
+
+            if skipped:
+                LOG.warning("{} entries from '{}' were already in the catalog and were skipped.".format(skipped, table_f))
+
+        return added
+
+    def _add_trait_row(self, name, row, metadata, added, skipped):
+        """ Inserts a trait row unless the genome already has one. Returns the updated (added, skipped) counts """
+        before = self.conn.total_changes
+        self.conn.execute("INSERT OR IGNORE INTO trait_rows (name, row, metadata) VALUES (?, ?, ?)", (name, row, json.dumps(metadata)))
+
+        if self.conn.total_changes == before:
+            return added, skipped + 1
+        else:
+            return added + 1, skipped
+
+    def get_metadata(self, name):
+        """ Returns a dict of the metadata for a genome """
+        row = self.conn.execute("SELECT metadata FROM trait_rows WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise ValueError("Genome '{}' has no traits in the catalog.".format(name))
+
+        return json.loads(row[0]) if row[0] else {}
+
+    def _select(self, subset, inverse):
+        """ Loads the subset into a temporary table and returns the SQL condition on name that selects the genomes to use """
+        self.conn.execute("DROP TABLE IF EXISTS temp.subset")
+        self.conn.execute("CREATE TEMP TABLE subset (name TEXT PRIMARY KEY)")
+        self.conn.executemany("INSERT OR IGNORE INTO temp.subset (name) VALUES (?)", ((name,) for name in subset))
+
+        if not subset:
+            return "1"
+        elif inverse:
+            return "name NOT IN (SELECT name FROM temp.subset)"
+        else:
+            return "name IN (SELECT name FROM temp.subset)"
+
+    def write_database(self, prefix="new_database", subset=[], inverse=False, verbose=False):
+        """
+        Writes a marker FASTA and trait table for the genomes in the catalog (optionally only a subset or,
+        with inverse, all but a subset). Returns a tuple (output_fasta, output_traits) like DatabaseManager.generate_database.
+        """
+        output_fasta = prefix + ".markers.fasta"
+        output_traits = prefix + ".traits.tab"
+
+        condition = self._select(subset, inverse)
+
+        if subset:
+            missing = self.conn.execute("SELECT COUNT(*) FROM temp.subset WHERE name NOT IN (SELECT name FROM markers)").fetchone()[0]
+            if missing:
+                LOG.warning("Some ids in subset list were not found in marker FASTA. Continuing with analysis anyway...")
+
+        # genomes with a marker but no traits are left out of both files
+        not_found = [row[0] for row in self.conn.execute("SELECT name FROM markers WHERE {} AND name NOT IN (SELECT name FROM trait_rows) ORDER BY id".format(condition))]
+        if not_found:
+            LOG.warning("Some genomes in the marker file(s) were not found in the trait table(s).")
+
+        if verbose:
+            print("{} were not found (these will not be in the output FASTA):".format(str(len(not_found))))
+            for g in not_found:
+                print(g)
+
+        with open(output_traits, 'w') as OUT:
+            OUT.write("\t".join(["genome"] + self.traits) + "\n")
+
+            query = "SELECT name, row FROM trait_rows WHERE {} AND name IN (SELECT name FROM markers) ORDER BY id".format(condition)
+            for name, row in self.conn.execute(query):
+                OUT.write("\t".join([name] + ([row] if row else [])) + "\n")
+
+        with open(output_fasta, 'wb') as OUT:
+            query = "SELECT record FROM markers WHERE {} AND name IN (SELECT name FROM trait_rows) ORDER BY id".format(condition)
+            for record, in self.conn.execute(query):
+                OUT.write(record)
+
+        self.conn.execute("DROP TABLE IF EXISTS temp.subset")
+
+        return output_fasta, output_traits
+
+
+def _json_value(value):
+    """ Converts a metadata value from a matrix into something json can store """
+    try:
+        return value.item()
+    except AttributeError:
+        return value
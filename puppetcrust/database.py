@@ -1,8 +1,11 @@
 
-from Bio import SeqIO
+import os
 import logging
 
-from puppetcrust.trait_table import TraitTableManager
+from puppetcrust.trait_table import TraitTableManager, TraitTableOffsets, NonNumericTraitError, write_rows
+from puppetcrust.fasta import FastaIndex, index_files, copy_records
+from puppetcrust.catalog import GenomeCatalog
+from puppetcrust import tracing
 
 
 logging.basicConfig()
@@ -13,16 +16,47 @@ LOG = logging.getLogger(__name__)
 class DatabaseManager(object):
     """ Manages files to make custom databases """
 
-    def __init__(self):
+    def __init__(self, cache=False, processes=1):
         self.marker_fastas = []
         self.trait_tables = []
 
+        # read trait tables through their binary caches and save the FASTA indexes
+        self.cache = cache
+
+        # number of FASTA files indexed at once
+        self.processes = processes
+
     def add_fasta(self, fasta_f):
         self.marker_fastas.append(fasta_f)
 
     def add_trait_table(self, table_f):
         self.trait_tables.append(table_f)
 
+    def build_catalog(self, catalog_f):
+        """ Ingests the FASTA files and trait tables added to the manager into a GenomeCatalog at catalog_f (adding to it if it exists). Returns the catalog """
+        catalog = GenomeCatalog(catalog_f)
+
+        for fasta_f in self.marker_fastas:
+            LOG.info("Added {} genomes from '{}'.".format(catalog.add_fasta(fasta_f), fasta_f))
+
+        for table_f in self.trait_tables:
+            LOG.info("Added {} genomes from '{}'.".format(catalog.add_trait_table(table_f, cache=self.cache), table_f))
+
+        return catalog
+
+    @staticmethod
+    @tracing.traced("generate_database")
+    def generate_from_catalog(catalog, prefix="new_database", subset=[], inverse=False, verbose=False):
+        """
+        Like generate_database but the genomes come from a GenomeCatalog (or the path to one) so only the
+        subset is read instead of every input file. Returns a tuple (output_fasta, output_traits).
+        """
+        if not isinstance(catalog, GenomeCatalog):
+            catalog = GenomeCatalog(catalog)
+
+        return catalog.write_database(prefix, subset=subset, inverse=inverse, verbose=verbose)
+
+    @tracing.traced("generate_database")
     def generate_database(self, prefix="new_database", subset=[], inverse=False, verbose=False):
         """ 
         Concatenates the files and removes duplicates and ensures trait tables and marker fastas have matching entries. Returns a tuple (output_fasta, output_traits). 
@@ -43,30 +77,30 @@ class DatabaseManager(object):
         subset = {k: 0 for k in subset}
 
         #
-        ## Make a list of FASTA seqs to write
+        ## Index the FASTA seqs to write
         #
 
-        # store the found sequences indexed by header
+        # store where the found sequences are indexed by header; the sequences themselves are
+        # only read when the output is written
         genomes = {}
-        for fasta_f in self.marker_fastas:
-            with open(fasta_f, 'r') as IN:
-                for record in SeqIO.parse(IN, "fasta"):
-                    if record.id in genomes:
-                        LOG.warning("Duplicate header found in FASTA files: '{}'".format(record.id))
-                    else:
+        for fasta_num, index in enumerate(index_files(self.marker_fastas, self.processes, persist=self.cache)):
+            for record_id, start, end in index:
+                if record_id in genomes:
+                    LOG.warning("Duplicate header found in FASTA files: '{}'".format(record_id))
+                else:
 
-                        # check if we are subsetting anything
-                        # write it unless found && inverse OR !found && !inverse
-                        if subset:
-                            if record.id in subset:
-                                if inverse:
-                                    subset[record.id] = 1
-                                    continue
-                            else:
-                                if not inverse:
-                                    subset[record.id] = 1
-                                    continue
-                        genomes[record.id] = record
+                    # check if we are subsetting anything
+                    # write it unless found && inverse OR !found && !inverse
+                    if subset:
+                        if record_id in subset:
+                            if inverse:
+                                subset[record_id] = 1
+                                continue
+                        else:
+                            if not inverse:
+                                subset[record_id] = 1
+                                continue
+                    genomes[record_id] = (fasta_num, start, end)
 
         # issue warnings if necessary
         if subset:
@@ -84,7 +118,7 @@ class DatabaseManager(object):
         with open(output_traits, 'w') as OUT:
             for trait_f in self.trait_tables:
                 
-                ttm = TraitTableManager(trait_f)
+                ttm = TraitTableManager(trait_f, cache=self.cache)
                 
                 # make sure the traits we are using are consistent throughout
                 if traits is None:
@@ -95,18 +129,7 @@ class DatabaseManager(object):
                     if set(traits) != set(ttm.traits): 
                         LOG.warning("Traits from '{}' don't match traits from the first table. Traits from the first table will be used to write the final one.".format(trait_f))
 
-                # process each entry in the table
-                for entry in ttm:
-                    try:
-                        if genomes_found[entry.name] == 0:
-                            genomes_found[entry.name] += 1
-                            entry.write(OUT, traits)
-                        else:
-                            # header already has an entry in the trait table. Skip.
-                            continue
-                    except:
-                        # header is not present in the FASTA. Skip.
-                        continue
+                self._write_table(OUT, ttm, traits, genomes_found)
 
         # issue more warnings if necessary
         not_found = []
@@ -125,13 +148,159 @@ class DatabaseManager(object):
                 print(g)
 
         # write the fasta
-        with open(output_fasta, 'w') as OUT:
-            for genome in genomes:
-                if genome in not_found:
-                    continue
+        with open(output_fasta, 'wb') as OUT:
+            self._write_fasta(OUT, genomes, genomes_found)
+
+
+        return output_fasta, output_traits
+
+    @tracing.traced("update_database")
+    def update_database(self, prefix="new_database", verbose=False):
+        """
+        Appends the genomes in the added FASTA files and trait tables to a database made by generate_database
+        (the files beginning with prefix). Returns a tuple (output_fasta, output_traits).
+
+        Genomes already in the database are skipped and its entries are left as they are. The genomes in the
+        database come from index sidecars of its files ('.pcidx' and '.offsets.json'), which are built by the
+        first update and extended with what each update appends, so later updates only read the new files.
+        Every trait table must have all the traits in the database's header.
+        """
+        output_fasta = prefix + ".markers.fasta"
+        output_traits = prefix + ".traits.tab"
+
+        for path in (output_fasta, output_traits):
+            if not os.path.isfile(path):
+                raise ValueError("'{}' doesn't exist. Refusing to update a database that hasn't been generated.".format(path))
+
+        # lines are appended after the last one, so the files must end with a newline before they are indexed
+        for path in (output_fasta, output_traits):
+            _end_last_line(path)
+
+        # genomes already in the database
+        database_index = FastaIndex.load_or_build(output_fasta, persist=True)
+        database_offsets = TraitTableOffsets.load_or_build(output_traits, persist=True)
+
+        existing = set(database_index.ids)
+        existing.update(database_offsets.names)
+
+        traits = TraitTableManager(output_traits).traits
+
+        # check the new tables against the header before anything is written
+        managers = []
+        for trait_f in self.trait_tables:
+            ttm = TraitTableManager(trait_f, cache=self.cache)
+
+            value_traits = set(ttm.value_traits)
+            missing = [trait for trait in traits if not trait.startswith("metadata_") and trait not in value_traits]
+            if missing:
+                raise ValueError("'{}' doesn't have trait '{}' (and {} others) from the header of '{}'. Refusing to append it.".format(trait_f, missing[0], len(missing) - 1, output_traits))
+
+            if set(traits) != set(ttm.traits):
+                LOG.warning("Traits from '{}' don't match the database's traits. Only the database's traits will be written.".format(trait_f))
+
+            managers.append(ttm)
+
+        # index the new sequences
+        genomes = {}
+        skipped = 0
+        for fasta_num, index in enumerate(index_files(self.marker_fastas, self.processes, persist=self.cache)):
+            for record_id, start, end in index:
+                if record_id in existing:
+                    skipped += 1
+                elif record_id in genomes:
+                    LOG.warning("Duplicate header found in FASTA files: '{}'".format(record_id))
                 else:
-                    SeqIO.write(genomes[genome], OUT, "fasta")
+                    genomes[record_id] = (fasta_num, start, end)
+
+        if skipped:
+            LOG.warning("{} genomes in the marker file(s) are already in the database and were skipped.".format(skipped))
+
+        # append the new entries
+        genomes_found = {g: 0 for g in genomes}
+        with open(output_traits, 'a') as OUT:
+            for ttm in managers:
+                self._write_table(OUT, ttm, traits, genomes_found)
+
+        not_found = [genome for genome in genomes_found if genomes_found[genome] == 0]
+        if not_found:
+            LOG.warning("Some genomes in the marker file(s) were not found in the trait table(s).")
+
+        if verbose:
+            print("{} were not found (these will not be in the output FASTA):".format(str(len(not_found))))
+            for g in not_found:
+                print(g)
+
+        with open(output_fasta, 'ab') as OUT:
+            self._write_fasta(OUT, genomes, genomes_found)
 
+        # index only what was appended so the next update doesn't rescan the database
+        database_offsets.extend(output_traits)
+        database_offsets.save(output_traits)
+        database_index.extend()
+        database_index.save()
+
+        LOG.info("Added {} genomes to '{}'.".format(len(genomes) - len(not_found), prefix))
 
         return output_fasta, output_traits
 
+    def _write_table(self, OUT, ttm, traits, genomes_found):
+        """ Writes the entries of a trait table whose genomes are in genomes_found and haven't been written yet (counting them there) """
+
+        # process the table in chunks, keeping the first entry for each header in the FASTA
+        # the columns are picked out in the order of the first table's traits
+        positions = {trait: indx for indx, trait in enumerate(ttm.value_traits)}
+        wanted = [trait for trait in traits if not trait.startswith("metadata_")]
+        columns = [positions[trait] for trait in wanted if trait in positions]
+        if len(columns) != len(wanted):
+            LOG.warning("Some traits from the first table aren't in '{}' and won't be written for its entries.".format(ttm.trait_table_f))
+
+        try:
+            for names, values in ttm.iter_chunks():
+                keep = []
+                for indx, name in enumerate(names):
+                    if genomes_found.get(name) == 0:
+                        genomes_found[name] += 1
+                        keep.append(indx)
+
+                write_rows(OUT, [names[indx] for indx in keep], values[keep][:, columns])
+
+        except NonNumericTraitError:
+            # fall back to entries, which skip everything the chunks already wrote
+            for entry in ttm:
+                try:
+                    if genomes_found[entry.name] == 0:
+                        genomes_found[entry.name] += 1
+                        entry.write(OUT, traits)
+                    else:
+                        # header already has an entry in the trait table. Skip.
+                        continue
+                except:
+                    # header is not present in the FASTA. Skip.
+                    continue
+
+    def _write_fasta(self, OUT, genomes, genomes_found):
+        """ Copies the records in genomes (header: (fasta number, start, end)) that were found in a trait table straight from the inputs """
+
+        # genomes is in file order, so each input is only opened once
+        ranges = {}
+        for genome in genomes:
+            if genomes_found[genome] == 0:
+                continue
+
+            fasta_num, start, end = genomes[genome]
+            ranges.setdefault(fasta_num, []).append((start, end))
+
+        for fasta_num in sorted(ranges):
+            copy_records(self.marker_fastas[fasta_num], ranges[fasta_num], OUT)
+
+
+def _end_last_line(path):
+    """ Adds a newline to the end of a file if it doesn't already end with one (so lines can be appended) """
+    with open(path, 'rb+') as IN:
+        IN.seek(0, os.SEEK_END)
+        if IN.tell() == 0:
+            return
+
+        IN.seek(-1, os.SEEK_END)
+        if IN.read(1) != b"\n":
+            IN.write(b"\n")
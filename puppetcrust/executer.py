@@ -2,15 +2,508 @@
 import subprocess
 import os
 import time
+import fnmatch
+import logging
+import multiprocessing
+from concurrent import futures
+
+from puppetcrust.step_cache import StepCache
+from puppetcrust import tracing
+
+import numpy
+
+# optional; without it the filtered OTU table is converted with the biom command
+try:
+    import biom
+except ImportError:
+    biom = None
+
+# optional; without it metagenomes can only be predicted with the PICRUSt scripts
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+class Backend(object):
+    """
+    Base class for the ways PicrustExecuter can run a job.
+
+    A job is a single shell command (PICRUSt steps chained with ';') with a name and paths for its
+    stdout and stderr. Job names passed to is_running and wait can be shell-style patterns.
+    """
+
+    def submit(self, command, job_name, out_f, err_f):
+        raise NotImplementedError
+
+    def is_running(self, job_name):
+        raise NotImplementedError
+
+    def exit_code(self, job_name):
+        """ Returns the exit code of a finished job or None if the backend doesn't know it """
+        return None
+
+    def poll(self, job_names):
+        """ Returns the set of job_names that are still running. Backends override this to check them all in one query """
+        return {name for name in job_names if self.is_running(name)}
+
+    def submit_array(self, manifest_f, count, job_name, out_f, err_f):
+        """
+        Runs each of the count lines of manifest_f as a command. Returns the names of the jobs to check.
+
+        Without real job arrays, each line becomes its own job called job_name.index. '%I' in out_f and
+        err_f is replaced by the (1-based) index like LSF does.
+        """
+        members = []
+        for index in range(1, count + 1):
+            member = "{}.{}".format(job_name, index)
+            self.submit("sed -n '{}p' {} | sh".format(index, manifest_f), member,
+                    out_f.replace("%I", str(index)), err_f.replace("%I", str(index)))
+            members.append(member)
+
+        return members
+
+
+class LSFBackend(Backend):
+    """ Submits jobs to an LSF cluster with bsub and checks them with bjobs """
+
+    def __init__(self, queue=None):
+        self.queue = queue
+
+    def submit(self, command, job_name, out_f, err_f):
+        bsub = ["bsub"]
+        if self.queue:
+            bsub += ["-q", self.queue]
+
+        subprocess.call(bsub + [
+                            "-o", out_f,
+                            "-e", err_f,
+                            "-J", job_name,
+                            command
+                            ])
+
+    def is_running(self, job_name):
+        # bjobs only prints to stdout if there are unfinished jobs matching the name
+        output = subprocess.check_output([
+                    "bjobs",
+                    "-J", job_name
+                ])
+
+        if output:
+            return True
+        else:
+            return False
+
+    def poll(self, job_names):
+        """ Checks all the jobs with a single bjobs call """
+        # bjobs exits non-zero and complains on stderr when nothing is unfinished, which is fine here
+        proc = subprocess.Popen(["bjobs", "-noheader", "-o", "stat job_name"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, _ = proc.communicate()
+
+        unfinished = set()
+        for line in output.decode().splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2 and fields[0] not in ("DONE", "EXIT"):
+                # elements of job arrays are listed as name[index]
+                unfinished.add(fields[1].strip().split("[")[0])
+
+        return {name for name in job_names if _matches_any(name, unfinished)}
+
+    def submit_array(self, manifest_f, count, job_name, out_f, err_f):
+        """ Submits a single LSF job array whose element i runs line i of manifest_f """
+        bsub = ["bsub"]
+        if self.queue:
+            bsub += ["-q", self.queue]
+
+        subprocess.call(bsub + [
+                            "-o", out_f,
+                            "-e", err_f,
+                            "-J", "{}[1-{}]".format(job_name, count),
+                            "sed -n \"${{LSB_JOBINDEX}}p\" {} | sh".format(manifest_f)
+                            ])
+
+        return [job_name]
+
+
+class LocalBackend(Backend):
+    """ Runs jobs on this machine, at most max_jobs at a time """
+
+    def __init__(self, max_jobs=None):
+        if max_jobs is None:
+            max_jobs = multiprocessing.cpu_count()
+
+        self.max_jobs = max_jobs
+
+        # the threads only wait on the shell subprocesses, which do the work
+        self._pool = futures.ThreadPoolExecutor(max_workers=max_jobs)
+        self.jobs = {}
+
+    @staticmethod
+    def _run(command, out_f, err_f):
+        with open(out_f, 'a') as OUT, open(err_f, 'a') as ERR:
+            return subprocess.call(command, shell=True, stdout=OUT, stderr=ERR)
+
+    def submit(self, command, job_name, out_f, err_f):
+        self.jobs[job_name] = self._pool.submit(self._run, command, out_f, err_f)
+
+    def _matching(self, job_name):
+        return [name for name in self.jobs if fnmatch.fnmatchcase(name, job_name)]
+
+    def is_running(self, job_name):
+        return any(not self.jobs[name].done() for name in self._matching(job_name))
+
+    def poll(self, job_names):
+        return {name for name in job_names if self.is_running(name)}
+
+    def exit_code(self, job_name):
+        try:
+            future = self.jobs[job_name]
+        except KeyError:
+            return None
+
+        if future.done():
+            return future.result()
+        else:
+            return None
+
+
+class FakeLSFBackend(Backend):
+    """
+    A scriptable stand-in for LSF so workflows can be tested without a cluster.
+
+    Every submission is recorded in submitted. A job reports as running for the given number of
+    is_running checks and then finishes with exit_code. Both can be scripted per job name pattern with
+    script(). If execute is True, the command is actually run (synchronously) when it is submitted.
+    """
+
+    def __init__(self, polls=0, exit_code=0, execute=False):
+        self.polls = polls
+        self.default_exit_code = exit_code
+        self.execute = execute
+
+        self.submitted = []
+        self.scripts = []
+        self.remaining = {}
+        self.exit_codes = {}
+
+    def script(self, job_name, polls=None, exit_code=None):
+        """ Sets the number of polls and/or exit code for jobs matching the job_name pattern """
+        self.scripts.append((job_name, polls, exit_code))
+
+    def submit(self, command, job_name, out_f, err_f):
+        self.submitted.append({"command": command, "job_name": job_name, "out": out_f, "err": err_f})
+
+        polls = self.polls
+        exit_code = self.default_exit_code
+        for pattern, scripted_polls, scripted_code in self.scripts:
+            if fnmatch.fnmatchcase(job_name, pattern):
+                if scripted_polls is not None:
+                    polls = scripted_polls
+                if scripted_code is not None:
+                    exit_code = scripted_code
+
+        if self.execute:
+            exit_code = LocalBackend._run(command, out_f, err_f)
+
+        self.remaining[job_name] = polls
+        self.exit_codes[job_name] = exit_code
+
+    def is_running(self, job_name):
+        running = False
+        for name in self.remaining:
+            if fnmatch.fnmatchcase(name, job_name) and self.remaining[name] > 0:
+                self.remaining[name] -= 1
+                running = True
+
+        return running
+
+    def exit_code(self, job_name):
+        if self.remaining.get(job_name, 1) > 0:
+            return None
+        else:
+            return self.exit_codes[job_name]
+
+
+BACKENDS = {
+        "lsf": LSFBackend,
+        "local": LocalBackend,
+        "fake_lsf": FakeLSFBackend
+        }
+
+def get_backend(name, **kwargs):
+    """ Makes a backend by name (one of BACKENDS) """
+    try:
+        return BACKENDS[name](**kwargs)
+    except KeyError:
+        raise ValueError("backend must be one of {}".format(", ".join(sorted(BACKENDS))))
+
+
+def _is_pattern(job_name):
+    return any(char in job_name for char in "*?[")
+
+
+def _matches_any(job_name, names):
+    """ Returns True if job_name (which may be a pattern) matches anything in the set names """
+    if _is_pattern(job_name):
+        return any(fnmatch.fnmatchcase(name, job_name) for name in names)
+    else:
+        return job_name in names
+
+
+class JobTracker(object):
+    """
+    Keeps track of submitted jobs and waits on any number of them with one batched status check per interval.
+
+    A job is finished as soon as its sentinel file (which holds the exit code of the command) appears, so
+    the backend is only queried for jobs without one. While nothing finishes, the time between checks
+    backs off from min_interval to max_interval.
+    """
+
+    def __init__(self, backend, min_interval=0.5, max_interval=10, backoff=1.5):
+        self.backend = backend
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+        # job_name: (sentinel paths, names the backend knows the job by)
+        self.jobs = {}
+        self.exit_codes = {}
+
+    def add(self, job_name, sentinel_f=None, members=None):
+        """
+        Tracks a job. sentinel_f can be a list of sentinels for a job array, which is finished once all of
+        them are written. members are the names the backend runs the job under (just job_name by default).
+        """
+        if sentinel_f is None:
+            sentinels = []
+        elif isinstance(sentinel_f, str):
+            sentinels = [sentinel_f]
+        else:
+            sentinels = list(sentinel_f)
+
+        self.jobs[job_name] = (sentinels, members or [job_name])
+        self.exit_codes.pop(job_name, None)
+
+    @staticmethod
+    def _read_sentinel(sentinel_f):
+        """ Returns the exit code in a sentinel file or None if it isn't there (yet) """
+        if sentinel_f is None:
+            return None
+
+        try:
+            with open(sentinel_f, 'r') as IN:
+                return int(IN.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _read_sentinels(self, job_name):
+        """ Returns a list of the exit codes from the job's sentinels (None for any not written) or None if it has none """
+        sentinels = self.jobs.get(job_name, ([], None))[0]
+        if not sentinels:
+            return None
+
+        return [self._read_sentinel(sentinel_f) for sentinel_f in sentinels]
+
+    @staticmethod
+    def _combine(codes):
+        """ The exit code of a job array is the first non-zero one, 0 if all are 0 and None if any are unknown """
+        for code in codes:
+            if code:
+                return code
+
+        if None in codes:
+            return None
+        else:
+            return 0
+
+    def _expand(self, job_names):
+        """ Expands patterns to the matching tracked jobs. Untracked names (or patterns matching nothing) are kept as is """
+        expanded = []
+        for job_name in job_names:
+            if job_name is None:
+                continue
+
+            if _is_pattern(job_name):
+                matches = sorted(name for name in self.jobs if fnmatch.fnmatchcase(name, job_name))
+                expanded.extend(matches or [job_name])
+            else:
+                expanded.append(job_name)
+
+        return expanded
+
+    def check(self, job_names):
+        """ Returns the set of job_names still running, recording exit codes for the ones that finished """
+        to_poll = []
+        for name in job_names:
+            if name in self.exit_codes:
+                continue
+
+            codes = self._read_sentinels(name)
+            if codes is None or None in codes:
+                to_poll.append(name)
+            else:
+                self.exit_codes[name] = self._combine(codes)
+
+        if not to_poll:
+            return set()
+
+        members = {name: self.jobs.get(name, (None, [name]))[1] for name in to_poll}
+        running_members = self.backend.poll([member for name in to_poll for member in members[name]])
+
+        running = set()
+        for name in to_poll:
+            if any(member in running_members for member in members[name]):
+                running.add(name)
+                continue
+
+            # the sentinels may have been written after they were checked, ask the backend about any still missing
+            codes = self._read_sentinels(name)
+            if codes is None:
+                codes = [self.backend.exit_code(member) for member in members[name]]
+            elif len(codes) == len(members[name]):
+                codes = [code if code is not None else self.backend.exit_code(member) for code, member in zip(codes, members[name])]
+
+            self.exit_codes[name] = self._combine(codes)
+
+        return running
+
+    def wait(self, job_names=None):
+        """ Waits for the jobs (all tracked jobs if None) to finish. Returns a dict of job_name: exit code (None if unknown) """
+        if job_names is None:
+            job_names = list(self.jobs)
+
+        job_names = self._expand(job_names)
+
+        interval = self.min_interval
+        running = self.check(job_names)
+        while running:
+            time.sleep(interval)
+
+            still_running = self.check(running)
+            if len(still_running) < len(running):
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+
+            running = still_running
+
+        return {name: self.exit_codes.get(name) for name in job_names}
+
+
+# exe: path, so each PICRUSt script is only looked up once
+_which_cache = {}
+
+def _which(exe):
+    """ Returns the full path to exe or just exe (with a warning) if it isn't on the PATH here """
+    if exe not in _which_cache:
+        with tracing.stage("which", exe=exe):
+            try:
+                _which_cache[exe] = subprocess.check_output(["which", exe]).decode().strip()
+            except (subprocess.CalledProcessError, OSError):
+                LOG.warning("Couldn't find '{}' on the PATH. Assuming it will be on the PATH where the job runs.".format(exe))
+                _which_cache[exe] = exe
+
+    return _which_cache[exe]
+
 
 class PicrustExecuter(object):
     """ Runs PICRUSt """
 
     job_id = 0
 
+    # how jobs are run and waited on, see set_backend
+    backend = LSFBackend()
+    tracker = JobTracker(backend)
+
+    # reuses the outputs of workflow steps that already ran on the same inputs, see set_step_cache
+    step_cache = None
+
+    @classmethod
+    def set_step_cache(cls, cache_dir, max_bytes=None):
+        """ Caches the outputs of predict_traits_wf steps in cache_dir (None turns caching off) """
+        if cache_dir is None:
+            cls.step_cache = None
+        else:
+            cls.step_cache = StepCache(cache_dir, max_bytes)
+
+    @classmethod
+    def set_backend(cls, backend):
+        """ Sets the backend used to run jobs. backend can be a Backend or a name from BACKENDS """
+        if not isinstance(backend, Backend):
+            backend = get_backend(backend)
+
+        cls.backend = backend
+        cls.tracker = JobTracker(backend)
+
     @classmethod
+    @tracing.traced("submit")
+    def _submit(cls, super_command, base_dir):
+        """ Submits a command with the backend. Returns the job name """
+        job_name = "picrust_cmd{}".format(cls.job_id)
+
+        # the command leaves its exit code in a sentinel file so the tracker can tell when it is done
+        sentinel_f = "{}/{}.exit".format(base_dir, job_name)
+        if os.path.isfile(sentinel_f):
+            os.remove(sentinel_f)
+
+        cls.backend.submit("( {} ); echo $? > {}".format(super_command, sentinel_f), job_name,
+                "{}/auto_picrust.out".format(base_dir),
+                "{}/auto_picrust.err".format(base_dir))
+        cls.tracker.add(job_name, sentinel_f)
+        cls.job_id += 1
+
+        return job_name
+
+    @classmethod
+    @tracing.traced("submit_array")
+    def submit_array(cls, jobs, array_dir):
+        """
+        Submits many jobs as a single job array tracked as one job. Returns the name of the array.
+
+        jobs is a list of (command, base_dir) like the ones from predict_traits_wf_command. Each job keeps
+        its own output files and sentinel in its base_dir; the array's manifest (one command per line)
+        is written to array_dir.
+        """
+        job_name = "picrust_array{}".format(cls.job_id)
+        cls.job_id += 1
+
+        array_dir = os.path.abspath(array_dir)
+        manifest_f = "{}/{}.manifest".format(array_dir, job_name)
+
+        sentinels = []
+        with open(manifest_f, 'w') as OUT:
+            for index, (command, base_dir) in enumerate(jobs, 1):
+                sentinel_f = "{}/{}.{}.exit".format(base_dir, job_name, index)
+                if os.path.isfile(sentinel_f):
+                    os.remove(sentinel_f)
+                sentinels.append(sentinel_f)
+
+                OUT.write("( {} ) >> {base}/auto_picrust.out 2>> {base}/auto_picrust.err; echo $? > {}\n".format(
+                    command, sentinel_f, base=base_dir))
+
+        members = cls.backend.submit_array(manifest_f, len(jobs), job_name,
+                "{}/{}.%I.out".format(array_dir, job_name),
+                "{}/{}.%I.err".format(array_dir, job_name))
+        cls.tracker.add(job_name, sentinels, members)
+
+        return job_name
+
+    @classmethod
+    @tracing.traced("predict_traits_wf")
     def predict_traits_wf(cls, tree, trait_table, type="trait", limit=None, base_dir=None):
         """ Runs the predict_traits_wf. Returns a name and an output path """
+        super_command, base_dir, predict_out = cls.predict_traits_wf_command(tree, trait_table, type, limit, base_dir)
+
+        job_name = cls._submit(super_command, base_dir)
+
+        return job_name, predict_out
+
+    @classmethod
+    def predict_traits_wf_command(cls, tree, trait_table, type="trait", limit=None, base_dir=None):
+        """ Sets up a predict_traits_wf without submitting it. Returns a tuple (command, base_dir, output path) """
         # make a directory to hold the analysis
         if base_dir is None:
             base_dir = os.getcwd() + "/" + "picrust_project"
@@ -53,24 +546,38 @@ class PicrustExecuter(object):
 
         predict_cmd = cls._get_predict_traits_command(fmt_table, asr_out, fmt_tree, predict_out, limit=limit)
 
+        # key each step on the contents of its inputs and the steps before it
+        if cls.step_cache is not None:
+            format_key = cls.step_cache.key("format_tree_and_trait_table", inputs=[trait_table, tree])
+            format_cmd = cls.step_cache.wrap(format_cmd, format_key, [format_dir])
+
+            asr_key = cls.step_cache.key("ancestral_state_reconstruction", parents=[format_key])
+            reconstruct_cmd = cls.step_cache.wrap(reconstruct_cmd, asr_key, [asr_out])
+
+            predict_key = cls.step_cache.key("predict_traits", inputs=[limit] if limit else [], args=["-a"], parents=[format_key, asr_key])
+            predict_cmd = cls.step_cache.wrap(predict_cmd, predict_key, [predict_out])
+
 
         # link all the necessary commands into a single command
         super_command = "; ".join([format_cmd, reconstruct_cmd, predict_cmd])
 
-        job_name = "picrust_cmd{}".format(cls.job_id)
-        subprocess.call([   "bsub",
-                            #"-q", "bigmem",
-                            "-o", "{}/auto_picrust.out".format(base_dir),
-                            "-e", "{}/auto_picrust.err".format(base_dir),
-                            "-J", job_name,
-                            super_command
-                            ])
-        cls.job_id += 1
-
-        return job_name, predict_out
+        return super_command, base_dir, predict_out
 
     @classmethod
-    def predict_metagenome(cls, otu_table, copy_numbers, trait_table, base_dir=None):
+    @tracing.traced("predict_metagenome")
+    def predict_metagenome(cls, otu_table, copy_numbers, trait_table, base_dir=None, in_process=False):
+        """
+        Submits a job that normalizes the OTU table by copy number and predicts the metagenome. Returns (job_name, predicted metagenome).
+
+        With in_process, the same calculation is done here with sparse matrices instead (if SciPy can be
+        imported) and job_name is None.
+        """
+        if in_process:
+            if sparse is not None:
+                return None, cls.predict_metagenome_in_process(otu_table, copy_numbers, trait_table, base_dir)
+            else:
+                LOG.warning("SciPy can't be imported. Submitting the metagenome prediction as a job instead.")
+
         # make a directory to hold the analysis
         if base_dir is None:
             base_dir = os.getcwd() + "/" + "picrust_project"
@@ -80,11 +587,15 @@ class PicrustExecuter(object):
         if not os.path.isdir(base_dir):
             os.mkdir(base_dir)
 
-        filter_out = base_dir + "/" + "filtered_OTU_table.tab"
-        cls._filter_otus(otu_table, trait_table, filter_out)
-
+        # write the filtered table straight to BIOM if biom can be imported here
         convert_out = base_dir + "/" + "filtered_OTU_table.biom"
-        convert_cmd = cls._get_biom_convert_command(filter_out, convert_out)
+        if biom is not None:
+            cls._filter_otus_to_biom(otu_table, trait_table, convert_out)
+            commands = []
+        else:
+            filter_out = base_dir + "/" + "filtered_OTU_table.tab"
+            cls._filter_otus(otu_table, trait_table, filter_out)
+            commands = [cls._get_biom_convert_command(filter_out, convert_out)]
 
         norm_out = base_dir + "/" + "normalized_OTU_table.biom"
         norm_cmd = cls._get_normalize_command(convert_out, copy_numbers, norm_out)
@@ -93,56 +604,104 @@ class PicrustExecuter(object):
         predict_cmd = cls._get_predict_metagenome_command(norm_out, trait_table, out=predict_out)
 
         # link all the necessary commands into a single command
-        super_command = "; ".join([convert_cmd, norm_cmd, predict_cmd])
+        super_command = "; ".join(commands + [norm_cmd, predict_cmd])
 
-        job_name = "picrust_cmd{}".format(cls.job_id)
-        subprocess.call([   "bsub",
-                            #"-q", "bigmem",
-                            "-o", "{}/auto_picrust.out".format(base_dir),
-                            "-e", "{}/auto_picrust.err".format(base_dir),
-                            "-J", job_name,
-                            super_command
-                            ])
-        cls.job_id += 1
+        job_name = cls._submit(super_command, base_dir)
 
         return job_name, predict_out
 
+    @classmethod
+    @tracing.traced("predict_metagenome_in_process")
+    def predict_metagenome_in_process(cls, otu_table, copy_numbers, trait_table, base_dir=None, block_rows=1000):
+        """
+        Does what the predict_metagenome job does in this process: the OTU counts are divided by their copy
+        numbers and multiplied by the trait table (OTUs x samples by OTUs x traits), all as sparse matrices.
+
+        Writes the predicted metagenome as a tab delimited table like predict_metagenomes.py -f and returns its path.
+        """
+        if base_dir is None:
+            base_dir = os.getcwd() + "/" + "picrust_project"
+        else:
+            base_dir = os.path.abspath(base_dir)
+
+        if not os.path.isdir(base_dir):
+            os.mkdir(base_dir)
+
+        samples, otus, counts = _read_otu_counts(otu_table, trait_table)
+        positions = {otu: indx for indx, otu in enumerate(otus)}
+
+        copy_columns, copy_number, copy_metadata = _read_picrust_rows(copy_numbers, positions)
+        if not copy_columns:
+            raise ValueError("'{}' doesn't have a copy number column.".format(copy_numbers))
+
+        copy_number = copy_number[:, 0].toarray().ravel()
+        if (copy_number == 0).any():
+            raise ValueError("OTU '{}' has a copy number of 0 in '{}'.".format(otus[numpy.flatnonzero(copy_number == 0)[0]], copy_numbers))
+
+        traits, trait_values, trait_metadata = _read_picrust_rows(trait_table, positions)
+
+        # OTUs x samples, then traits x samples
+        normalized = sparse.diags(1 / copy_number).dot(counts)
+        predicted = trait_values.T.tocsr().dot(normalized).tocsr()
+
+        # descriptions of the traits are written in a last column like PICRUSt does
+        metadata_names = sorted(trait_metadata)
+
+        predict_out = base_dir + "/" + "predicted_metagenome.tab"
+        with open(predict_out, 'w') as OUT:
+            OUT.write("# Constructed from biom file\n")
+            OUT.write("\t".join(["#OTU ID"] + samples + metadata_names) + "\n")
+
+            for start in range(0, len(traits), block_rows):
+                block = predicted[start:start + block_rows].toarray().tolist()
+
+                for indx, row in enumerate(block):
+                    to_write = [traits[start + indx]] + [str(value) for value in row]
+                    to_write += [trait_metadata[name][start + indx] for name in metadata_names]
+                    OUT.write("\t".join(to_write) + "\n")
+
+        LOG.info("Predicted {} traits for {} samples from {} OTUs.".format(len(traits), len(samples), len(otus)))
+
+        return predict_out
+
     @classmethod
     def wait_for_job(cls, job_name="picrust_cmd*"):
-        """ waits for job to complete, checks every 10 seconds """
-        while cls._job_running(job_name):
-            time.sleep(10)
+        """ waits for job (or all jobs matching a pattern) to complete """
+        return cls.wait_for_jobs([job_name])
 
-    @staticmethod
-    def _job_running(job_name="picrust_cmd*"):
+    @classmethod
+    @tracing.traced("wait_for_jobs")
+    def wait_for_jobs(cls, job_names):
+        """ waits for all the jobs to complete, checking them together. Returns a dict of job_name: exit code """
+        exit_codes = cls.tracker.wait(job_names)
 
-        output = subprocess.check_output([
-                    "bjobs",
-                    "-J", "picrust_cmd*"
-                ])
-        #print(output)
-        if output:
-            return True
-        else:
-            return False
+        for job_name, exit_code in sorted(exit_codes.items()):
+            if exit_code:
+                LOG.warning("Job '{}' exited with code {}.".format(job_name, exit_code))
+
+        return exit_codes
+
+    @classmethod
+    def _job_running(cls, job_name="picrust_cmd*"):
+        return cls.backend.is_running(job_name)
 
     @staticmethod
     def _get_format_command(trait_tab, tree, out):
-        exe = subprocess.check_output(["which", "format_tree_and_trait_table.py"]).strip()
+        exe = _which("format_tree_and_trait_table.py")
         format_files = "python {exe} -t {tree} -i {trait_tab} -o {out}".format(exe=exe, tree=tree, trait_tab=trait_tab, out=out)
 
         return format_files
 
     @staticmethod
     def _get_asr_command(trait_table, tree, out):
-        exe = subprocess.check_output(["which", "ancestral_state_reconstruction.py"]).strip()
+        exe = _which("ancestral_state_reconstruction.py")
         asr = "python {exe} -i {trait_table} -t {tree} -o {out}".format(exe=exe, trait_table=trait_table, tree=tree, out=out)
 
         return asr
 
     @staticmethod
     def _get_predict_traits_command(trait_table, asr_table, tree, out, limit=None):
-        exe = subprocess.check_output(["which", "predict_traits.py"]).strip()
+        exe = _which("predict_traits.py")
         predict = "python {exe} -i {trait_table} -t {tree} -r {asr_table} -o {out} -a".format(exe=exe, trait_table=trait_table, asr_table=asr_table, tree=tree, out=out)
 
         # add optional limit predictions to list or OTU table
@@ -152,58 +711,23 @@ class PicrustExecuter(object):
         return predict
 
     @staticmethod
+    @tracing.traced("filter_otus")
     def _filter_otus(otu_f, traits_f, out_f="filtered_otu_table.tab"):
         """ Filters an otu table to only include OTUs that are in the trait table. Writes new table to out_f """
+        with open(out_f, 'w') as OUT:
+            for line in _iter_filtered_otus(otu_f, traits_f):
+                OUT.write(line)
 
-        # read in a list of OTUs in the trait table
-        otus_to_keep = []
-        with open(traits_f, "r") as IN:
-            for line in IN:
-
-                # skip comments
-                if line.startswith("#"): 
-                    continue
-
-                name, counts = line.split("\t", 1)
-                otus_to_keep.append(name)
-
-        # filter table and write new one
-        found_header = False        # this stores whether a line that could be the header has been found
-        num_filtered = 0
-        with open(otu_f, 'r') as IN, open(out_f, 'w') as OUT:
-            for line in IN:
-
-                # write comments
-                if line.startswith("#"):
-                    OUT.write(line)
-                    continue
-                
-                name, counts = line.split("\t", 1)
-
-                if name in otus_to_keep:
-                    OUT.write(line)
-                else:
-                    # now we need to consider whether or not this could be the header
-                    if found_header is False:
-
-                        # we will do this by trying to convert a few of the "count" fields into
-                        # numbers in the hope that sample names will be non-numeric
-                        first, second, third, rest = counts.split("\t", 3)
-                        try:
-                            float(first)
-                            float(second)
-                            float(third)
-
-                        except ValueError:      # one of the 3 had an alphabet character
-                            OUT.write(line)
-                            continue 
-
-                        # if they were all numbers, lets assume we found the header
-                        found_header = True
-                    
-                    num_filtered += 1
+    @staticmethod
+    @tracing.traced("filter_otus")
+    def _filter_otus_to_biom(otu_f, traits_f, out_f="filtered_otu_table.biom"):
+        """ Like _filter_otus but writes the new table as BIOM (what 'biom convert' would make from it). Requires biom """
+        # from_tsv treats anything but a list as a file it can seek
+        table = biom.Table.from_tsv(list(_iter_filtered_otus(otu_f, traits_f)), None, None, lambda x: x)
+        table.type = "OTU table"
 
-        print("Removed {} OTUs from the OTU table that had no predicted traits.".format(num_filtered))
+        with open(out_f, 'w') as OUT:
+            OUT.write(table.to_json("puppetcrust"))
 
     @staticmethod
     def _get_biom_convert_command(otu_f, out_f):
@@ -215,14 +739,180 @@ class PicrustExecuter(object):
 
     @staticmethod
     def _get_normalize_command(otu_table, copy_numbers, out):
-        exe = subprocess.check_output(["which", "normalize_by_copy_number.py"]).strip()
+        exe = _which("normalize_by_copy_number.py")
         normalize = "python {exe} -i {otu_table} -c {copy_numbers} -o {out}".format(exe=exe, otu_table=otu_table, copy_numbers=copy_numbers, out=out)
 
         return normalize
 
     @staticmethod
     def _get_predict_metagenome_command(otu_table, trait_table, out):
-        exe = subprocess.check_output(["which", "predict_metagenomes.py"]).strip()
+        exe = _which("predict_metagenomes.py")
         predict = "python {exe} -i {otu_table} -c {trait_table} -o {out} -f".format(exe=exe, otu_table=otu_table, trait_table=trait_table, out=out)
 
         return predict
+
+
+def _iter_filtered_otus(otu_f, traits_f):
+    """ Yields the lines of an OTU table (comments, header and OTUs) for the OTUs in the trait table """
+
+    # read in a set of OTUs in the trait table
+    otus_to_keep = set()
+    with open(traits_f, "r") as IN:
+        for line in IN:
+
+            # skip comments
+            if line.startswith("#"):
+                continue
+
+            otus_to_keep.add(line.split("\t", 1)[0])
+
+    # filter the table
+    found_header = False        # this stores whether a line that could be the header has been found
+    num_filtered = 0
+    with open(otu_f, 'r') as IN:
+        for line in IN:
+
+            # keep comments
+            if line.startswith("#"):
+                yield line
+                continue
+
+            name, counts = line.split("\t", 1)
+
+            if name in otus_to_keep:
+                yield line
+            else:
+                # now we need to consider whether or not this could be the header
+                if found_header is False:
+
+                    # we will do this by trying to convert a few of the "count" fields into
+                    # numbers in the hope that sample names will be non-numeric
+                    first, second, third, rest = counts.split("\t", 3)
+                    try:
+                        float(first)
+                        float(second)
+                        float(third)
+
+                    except ValueError:      # one of the 3 had an alphabet character
+                        yield line
+                        continue
+
+                    # if they were all numbers, lets assume we found the header
+                    found_header = True
+
+                num_filtered += 1
+
+    print("Removed {} OTUs from the OTU table that had no predicted traits.".format(num_filtered))
+
+
+def _read_otu_counts(otu_f, traits_f):
+    """
+    Reads the OTUs in the trait table from a tab delimited OTU table (filtered like _filter_otus).
+
+    Returns (sample ids, OTU ids, counts) where counts is a CSR matrix of OTUs x samples. A last column
+    of taxonomy is left out.
+    """
+    samples = None
+    otus = []
+    data = []
+    indices = []
+    indptr = [0]
+    for line in _iter_filtered_otus(otu_f, traits_f):
+        fields = line.rstrip("\r\n").split("\t")
+
+        # the header is the last comment with columns or a line whose counts aren't numbers
+        if line.startswith("#"):
+            if len(fields) > 1:
+                samples = _sample_columns(fields)
+            continue
+
+        if samples is None:
+            try:
+                numpy.array(fields[1:], dtype=numpy.float64)
+            except ValueError:
+                samples = _sample_columns(fields)
+                continue
+
+            raise ValueError("'{}' doesn't have a header line.".format(otu_f))
+
+        try:
+            values = numpy.array(fields[1:len(samples) + 1], dtype=numpy.float64)
+        except ValueError:
+            raise ValueError("OTU '{}' in '{}' has counts that aren't numbers.".format(fields[0], otu_f))
+
+        otus.append(fields[0])
+        nonzero = numpy.flatnonzero(values)
+        data.append(values[nonzero])
+        indices.append(nonzero)
+        indptr.append(indptr[-1] + len(nonzero))
+
+    if samples is None:
+        raise ValueError("'{}' doesn't have a header line.".format(otu_f))
+
+    counts = sparse.csr_matrix((_concatenate(data), _concatenate(indices), indptr), shape=(len(otus), len(samples)))
+
+    return samples, otus, counts
+
+
+def _sample_columns(header):
+    """ Returns the sample ids from the fields of an OTU table header, leaving out a last taxonomy column """
+    samples = header[1:]
+    if samples and samples[-1].lower() in ("taxonomy", "consensus lineage", "consensuslineage"):
+        samples = samples[:-1]
+
+    return samples
+
+
+def _read_picrust_rows(table_f, positions):
+    """
+    Reads the rows named in positions (name: row) from a PICRUSt table like the precalculated trait and
+    16S copy number tables. Columns and rows that begin with 'metadata_' are left out of the values.
+
+    Returns (columns, values, metadata) where values is a CSR matrix with a row for each name and
+    metadata is a dict of the metadata rows (without the 'metadata_') as lists with a value per column.
+    """
+    data = []
+    rows = []
+    indices = []
+    metadata = {}
+    found = set()
+    with open(table_f, 'r') as IN:
+        headers = IN.readline().rstrip("\r\n").split("\t")[1:]
+        keep = [indx for indx, header in enumerate(headers) if not header.startswith("metadata_")]
+        columns = [headers[indx] for indx in keep]
+
+        for line in IN:
+            fields = line.rstrip("\r\n").split("\t")
+            name = fields[0]
+            fields = fields[1:]
+
+            if name.startswith("metadata_"):
+                metadata[name.split("metadata_", 1)[1]] = [fields[indx] if indx < len(fields) else "" for indx in keep]
+                continue
+
+            # keep the first row for each name
+            if name not in positions or name in found:
+                continue
+
+            found.add(name)
+            values = numpy.array([fields[indx] for indx in keep], dtype=numpy.float64)
+            nonzero = numpy.flatnonzero(values)
+            data.append(values[nonzero])
+            indices.append(nonzero)
+            rows.append(numpy.repeat(positions[name], len(nonzero)))
+
+    if len(found) != len(positions):
+        missing = [name for name in positions if name not in found]
+        raise ValueError("'{}' doesn't have a row for '{}' (and {} others).".format(table_f, missing[0], len(missing) - 1))
+
+    values = sparse.csr_matrix((_concatenate(data), (_concatenate(rows), _concatenate(indices))), shape=(len(positions), len(columns)))
+
+    return columns, values, metadata
+
+
+def _concatenate(arrays):
+    """ numpy.concatenate that allows an empty list """
+    if arrays:
+        return numpy.concatenate(arrays)
+    else:
+        return numpy.array([], dtype=numpy.int64)
@@ -0,0 +1,205 @@
+
+"""
+Reads and writes FASTA files as raw bytes.
+
+Records are never parsed into sequences, so they are copied with their original header lines and
+line wrapping. Only the id of each record (the first word of its header, as in Biopython) is decoded.
+"""
+
+import os
+import mmap
+import logging
+import multiprocessing
+
+from puppetcrust import tracing, sidecar
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+def record_id(header):
+    """ Returns the id of a record from its header line (bytes, with or without the '>') the same way Biopython does """
+    title = header.rstrip(b"\r\n")
+    if title.startswith(b">"):
+        title = title[1:]
+
+    fields = title.split(None, 1)
+    if fields:
+        return fields[0].decode("utf-8")
+    else:
+        return ""
+
+
+class FastaIndex(object):
+    """
+    The byte range of every record in a FASTA file (like samtools faidx, but for whole records).
+
+    Records can then be copied to a new file without parsing or holding any sequences. The index can
+    be saved as a sidecar ('<fasta>.pcidx') that is only trusted while the FASTA's sidecar.file_key matches.
+    """
+
+    version = 2
+
+    def __init__(self, fasta_f, ids, starts, ends):
+        self.fasta_f = fasta_f
+        self.ids = list(ids)
+        self.starts = list(starts)
+        self.ends = list(ends)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        """ Yields (id, start, end) for each record in file order """
+        return zip(self.ids, self.starts, self.ends)
+
+    @classmethod
+    def build(cls, fasta_f, offset=0):
+        """
+        Indexes a FASTA with a single scan for the starts of headers (anything before the first header is ignored).
+
+        Only the records starting at or after the byte offset are indexed.
+        """
+        ids = []
+        starts = []
+        ends = []
+        with open(fasta_f, 'rb') as IN:
+            size = os.fstat(IN.fileno()).st_size
+            if offset >= size:
+                return cls(fasta_f, ids, starts, ends)
+
+            data = mmap.mmap(IN.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if data[offset:offset + 1] == b">" and (offset == 0 or data[offset - 1:offset] == b"\n"):
+                    start = offset
+                else:
+                    start = data.find(b"\n>", offset)
+                    if start != -1:
+                        start += 1
+
+                while start != -1:
+                    if ids:
+                        ends.append(start)
+
+                    header_end = data.find(b"\n", start)
+                    ids.append(record_id(data[start:header_end if header_end != -1 else size]))
+                    starts.append(start)
+
+                    start = data.find(b"\n>", start + 1)
+                    if start != -1:
+                        start += 1
+
+                if ids:
+                    ends.append(size)
+
+            finally:
+                data.close()
+
+        return cls(fasta_f, ids, starts, ends)
+
+    @classmethod
+    def load_or_build(cls, fasta_f, persist=False):
+        """ Returns the saved index if it is current, otherwise builds it (saving it if persist is True) """
+        key = sidecar.file_key(fasta_f)
+
+        saved = sidecar.load(fasta_f + ".pcidx", cls.version, key, "FASTA index")
+        if saved is not None:
+            return cls(fasta_f, saved["ids"], saved["starts"], saved["ends"])
+
+        index = cls.build(fasta_f)
+
+        if persist:
+            index.save(key)
+
+        return index
+
+    def extend(self):
+        """ Indexes the records appended to the FASTA since it was indexed. Returns the number of records added """
+        offset = self.ends[-1] if self.ends else 0
+        new = self.build(self.fasta_f, offset)
+
+        # the last record runs up to the first new header like it would in a full build
+        if self.ends:
+            self.ends[-1] = new.starts[0] if new.starts else os.path.getsize(self.fasta_f)
+
+        self.ids.extend(new.ids)
+        self.starts.extend(new.starts)
+        self.ends.extend(new.ends)
+
+        return len(new)
+
+    def save(self, key=None):
+        """ Saves the index as the FASTA's sidecar. key is the FASTA's sidecar.file_key when it was indexed (now if None) """
+        if key is None:
+            key = sidecar.file_key(self.fasta_f)
+
+        saved = {"ids": self.ids, "starts": self.starts, "ends": self.ends}
+        sidecar.save(self.fasta_f + ".pcidx", self.version, key, saved, "FASTA index")
+
+
+def _load_or_build_index(args):
+    """ Pool worker for index_files """
+    fasta_f, persist = args
+    return FastaIndex.load_or_build(fasta_f, persist)
+
+
+@tracing.traced("index_fasta")
+def index_files(fasta_fs, processes=1, persist=False):
+    """ Returns a FastaIndex for each file in fasta_fs (in the same order), indexing up to processes files at a time """
+    jobs = [(fasta_f, persist) for fasta_f in fasta_fs]
+
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            return pool.map(_load_or_build_index, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return [_load_or_build_index(job) for job in jobs]
+
+
+def read_fasta(fasta_f, buffer_size=1 << 20):
+    """ Yields (id, record) for each record in a FASTA in one streaming pass, where record is the raw bytes of the record ending in a newline """
+    with open(fasta_f, 'rb', buffer_size) as IN:
+        name = None
+        lines = []
+        for line in IN:
+            if line.startswith(b">"):
+                if name is not None:
+                    yield name, b"".join(lines)
+
+                name = record_id(line)
+                lines = []
+
+            # anything before the first header is ignored
+            if name is not None:
+                lines.append(line)
+
+        if name is not None:
+            if not lines[-1].endswith(b"\n"):
+                lines.append(b"\n")
+
+            yield name, b"".join(lines)
+
+
+def copy_records(fasta_f, ranges, fh, buffer_size=1 << 20):
+    """ Copies the records at the (start, end) byte ranges of fasta_f to the binary file handle fh, in order """
+    with open(fasta_f, 'rb') as IN:
+        for start, end in ranges:
+            IN.seek(start)
+
+            remaining = end - start
+            last = b""
+            while remaining:
+                chunk = IN.read(min(remaining, buffer_size))
+                if not chunk:
+                    break
+
+                fh.write(chunk)
+                remaining -= len(chunk)
+                last = chunk
+
+            # the last record in a file may not end with a newline
+            if last and not last.endswith(b"\n"):
+                fh.write(b"\n")
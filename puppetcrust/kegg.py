@@ -0,0 +1,131 @@
+
+import os
+import logging
+
+from puppetcrust import sidecar
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+LEVELS = [1, 2, 3]
+
+
+class KOHierarchy(object):
+    """
+    The KEGG pathways of each KO, compiled from a KO metadata file.
+
+    The file has a header and then lines like:
+    ko\tdescription\tlvl1;lvl2;lvl3|lvl1;lvl2;lvl3|......
+
+    Level 1 is the top level.
+    Level 2 is an intermediate level (Corresponding approx to COGs)
+    Level 3 is the pathway level
+
+    The lookups for each level are built once, so KO -> pathways and pathway -> KOs are dict lookups.
+    A KO listed more than once under a pathway appears once per listing, like the old parsers.
+    """
+
+    version = 2
+
+    # compiled hierarchies by path and file_key so a file is only read once per process
+    _loaded = {}
+
+    def __init__(self, kos, lineages):
+        # lineages[i] is a list of the full "lvl1;lvl2;lvl3" pathways of kos[i]
+        self.kos = list(kos)
+        self.lineages = list(lineages)
+
+        self._ko_to_pathways = {}
+        self._pathway_to_kos = {}
+
+    @staticmethod
+    def _check_level(level):
+        if level not in LEVELS:
+            raise ValueError("Level must be 1, 2, or 3.")
+
+    def _compile(self, level):
+        """ Builds the lookups for a level """
+        ko_to_pathways = {}
+        pathway_to_kos = {}
+        for ko, lineage in zip(self.kos, self.lineages):
+            for pathway in lineage:
+                name = ";".join(pathway.split(";")[:level])
+
+                ko_to_pathways.setdefault(ko, []).append(name)
+                pathway_to_kos.setdefault(name, []).append(ko)
+
+        self._ko_to_pathways[level] = ko_to_pathways
+        self._pathway_to_kos[level] = pathway_to_kos
+
+    def ko_to_pathways(self, level=2):
+        """ Returns a dict of KO: list of pathways at level. Don't modify it; it is shared """
+        self._check_level(level)
+        if level not in self._ko_to_pathways:
+            self._compile(level)
+
+        return self._ko_to_pathways[level]
+
+    def pathway_to_kos(self, level=2):
+        """ Returns a dict of pathway at level: list of KOs. Don't modify it; it is shared """
+        self._check_level(level)
+        if level not in self._pathway_to_kos:
+            self._compile(level)
+
+        return self._pathway_to_kos[level]
+
+    def pathways(self, ko, level=2):
+        """ Returns a list of the pathways of a KO at level (empty if the KO has none) """
+        return list(self.ko_to_pathways(level).get(ko, []))
+
+    def get_kos(self, pathway, level=2):
+        """ Returns a list of the KOs in a pathway at level (empty if there are none) """
+        return list(self.pathway_to_kos(level).get(pathway, []))
+
+    @classmethod
+    def from_file(cls, ko_metadata_f):
+        """ Parses a KO metadata file. The pathways are the last column; KOs without any are left out """
+        kos = []
+        lineages = []
+        with open(ko_metadata_f, 'r') as IN:
+            # skip header line
+            IN.readline()
+
+            for line in IN:
+                fields = line.rstrip("\r\n").split("\t")
+                if len(fields) < 2 or not fields[-1]:
+                    continue
+
+                # multiple pathways sep by "|"
+                kos.append(fields[0])
+                lineages.append(fields[-1].split("|"))
+
+        return cls(kos, lineages)
+
+    @classmethod
+    def load(cls, ko_metadata_f, persist=True):
+        """
+        Returns the hierarchy for a KO metadata file.
+
+        It comes from this process's earlier loads or a '<file>.hierarchy.json' sidecar if either is current,
+        otherwise the file is parsed (and the sidecar saved if persist is True).
+        """
+        key = sidecar.file_key(ko_metadata_f)
+        memo_key = (os.path.abspath(ko_metadata_f), key["size"], key["mtime"], key["hash"])
+        if memo_key in cls._loaded:
+            return cls._loaded[memo_key]
+
+        sidecar_f = ko_metadata_f + ".hierarchy.json"
+
+        saved = sidecar.load(sidecar_f, cls.version, key, "KO hierarchy")
+        if saved is not None:
+            hierarchy = cls(saved["kos"], saved["lineages"])
+        else:
+            hierarchy = cls.from_file(ko_metadata_f)
+
+            if persist:
+                sidecar.save(sidecar_f, cls.version, key, {"kos": hierarchy.kos, "lineages": hierarchy.lineages}, "KO hierarchy")
+
+        cls._loaded[memo_key] = hierarchy
+
+        return hierarchy
@@ -0,0 +1,108 @@
+
+"""
+Reads the tip names of Newick trees without building the tree.
+
+The tree is tokenized as it is read, so only the names are kept in memory. Labels after a ')' are
+internal node names (or support values) and are skipped along with branch lengths and [comments].
+Names are read like Bio.Phylo does: quotes are removed ('' is a quote) and underscores are kept.
+"""
+
+import re
+import logging
+
+from puppetcrust import tracing, step_cache
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+_TOKENS = re.compile(r"""
+    (?P<quoted>'(?:[^']|'')*'(?!'))
+    |(?P<comment>\[[^\]]*\])
+    |(?P<punct>[(),:;])
+    |(?P<label>[^\s(),:;\[\]']+)
+    |(?P<space>\s+)
+    |(?P<other>.)
+    """, re.VERBOSE | re.DOTALL)
+
+
+def _tokens(IN, chunk_size):
+    """ Yields (kind, text) for the tokens of an open Newick file, reading it chunk_size characters at a time """
+    buffer = ""
+    eof = False
+    while not eof:
+        chunk = IN.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+
+        position = 0
+        for match in _TOKENS.finditer(buffer):
+            # a token touching the end of the buffer (or a quote or comment that isn't closed in it) may continue in the next chunk
+            if not eof and (match.end() == len(buffer) or match.lastgroup == "other"):
+                break
+
+            if match.lastgroup == "other":
+                raise ValueError("Unexpected '{}' in Newick tree (unclosed quote or comment?).".format(match.group()))
+
+            position = match.end()
+            if match.lastgroup not in ("space", "comment"):
+                yield match.lastgroup, match.group()
+
+        buffer = buffer[position:]
+
+
+def read_tips(tree_f, chunk_size=1 << 20):
+    """ Returns a list of the tip names of the first tree in a Newick file, in the order they appear """
+    tips = []
+    empty = 0
+
+    # a label is a tip if it comes right after '(' or ',' (or starts the tree)
+    expecting_tip = True
+    in_length = False
+    with open(tree_f, 'r') as IN:
+        for kind, text in _tokens(IN, chunk_size):
+            if kind == "punct":
+                in_length = text == ":"
+
+                if expecting_tip and text in ",):":
+                    empty += 1
+
+                if text == ";":
+                    break
+
+                expecting_tip = text in "(,"
+
+            elif in_length:
+                # branch length
+                in_length = False
+
+            elif expecting_tip:
+                if kind == "quoted":
+                    text = text[1:-1].replace("''", "'")
+
+                tips.append(text)
+                expecting_tip = False
+
+    if empty:
+        LOG.warning("{} tips in '{}' have no name and were skipped.".format(empty, tree_f))
+
+    return tips
+
+
+# tip lists by file hash so each tree is only read once per process
+_tips = {}
+
+
+@tracing.traced("read_tree_tips", tracing.argument(0))
+def load_tips(tree_f):
+    """
+    Returns a list of the tip names of a Newick file like read_tips, reading each tree only once.
+
+    Tips are cached by the hash of the file, so copies of a tree share one list and a changed file is
+    read again. Don't modify the list; it is shared.
+    """
+    file_hash = step_cache.file_hash(tree_f)
+    if file_hash not in _tips:
+        _tips[file_hash] = read_tips(tree_f)
+
+    return _tips[file_hash]
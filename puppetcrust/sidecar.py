@@ -0,0 +1,97 @@
+
+"""
+JSON sidecars that save something built from a file (an index, a parsed table...) next to it.
+
+A sidecar holds a version, the file_key of the source when it was built and a payload. It is only
+trusted while both match, and it is written to a temp file that is moved into place so a crash never
+leaves half of one behind.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+def file_key(path, sample_bytes=1 << 20):
+    """
+    Returns a dict identifying the contents of path by size, mtime and a SHA-1 of its first and last sample_bytes.
+
+    Hashing only the ends keeps checking a multi-GB file cheap while still catching most rewrites
+    that happen to keep the size and mtime.
+    """
+    stat = os.stat(path)
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as IN:
+        sha.update(IN.read(sample_bytes))
+
+        if stat.st_size > sample_bytes:
+            IN.seek(max(sample_bytes, stat.st_size - sample_bytes))
+            sha.update(IN.read(sample_bytes))
+
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": sha.hexdigest()}
+
+
+def load(sidecar_f, version, source, description="Sidecar"):
+    """
+    Returns the payload saved in sidecar_f or None if it is missing, from another version, stale (its source
+    key isn't source) or corrupt. description names the sidecar in log messages.
+    """
+    if not os.path.isfile(sidecar_f):
+        return None
+
+    try:
+        with open(sidecar_f, 'r') as IN:
+            saved = json.load(IN)
+
+        if saved["version"] != version:
+            LOG.info("{} '{}' is from an older version. Rebuilding.".format(description, sidecar_f))
+            return None
+
+        if saved["source"] != source:
+            LOG.info("{} '{}' is stale. Rebuilding.".format(description, sidecar_f))
+            return None
+
+        return saved["payload"]
+
+    except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+        LOG.warning("{} '{}' is corrupt ({}). Rebuilding.".format(description, sidecar_f, e))
+        return None
+
+
+def save(sidecar_f, version, source, payload, description="Sidecar", files=None):
+    """
+    Writes payload (anything json can dump) to sidecar_f with the version and source key. Returns True if it was written.
+
+    files is an optional dict of path: function(binary file handle) for companion files that are written
+    (and moved into place) before the sidecar, since the sidecar is what marks them as valid. If anything
+    can't be written, a warning is logged and the temp files are removed.
+    """
+    files = files or {}
+    tmp_suffix = ".tmp{}".format(os.getpid())
+
+    try:
+        for path, write in files.items():
+            with open(path + tmp_suffix, 'wb') as OUT:
+                write(OUT)
+
+        with open(sidecar_f + tmp_suffix, 'w') as OUT:
+            json.dump({"version": version, "source": source, "payload": payload}, OUT)
+
+        for path in files:
+            os.replace(path + tmp_suffix, path)
+        os.replace(sidecar_f + tmp_suffix, sidecar_f)
+
+        return True
+
+    except (IOError, OSError) as e:
+        LOG.warning("Unable to write {} '{}' ({}). Continuing without it.".format(description.lower(), sidecar_f, e))
+        for path in list(files) + [sidecar_f]:
+            if os.path.isfile(path + tmp_suffix):
+                os.remove(path + tmp_suffix)
+
+        return False
@@ -0,0 +1,231 @@
+
+"""
+A content-addressed cache for the steps of PICRUSt workflows.
+
+Each step is keyed by a hash of its name, its arguments, the contents of its input files and the keys
+of the steps it depends on. The outputs of a step that finished successfully are stored under its key
+and a later step with the same key hard links (or copies) them into place instead of running.
+
+The jobs run on other machines, so this file is also a standalone script that wraps a single step
+(see StepCache.wrap). It only uses the standard library so it can run without the rest of the package.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+def _link_or_copy(src, dest):
+    """ Hard links src (a file or directory) to dest, copying anything that can't be linked """
+    if os.path.isdir(src):
+        os.mkdir(dest)
+        for name in os.listdir(src):
+            _link_or_copy(os.path.join(src, name), os.path.join(dest, name))
+    else:
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _size(path):
+    """ Returns the size in bytes of a file or everything in a directory """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+
+    return total
+
+
+# (path, size, mtime): hash so unchanged files are only hashed once per process
+_file_hashes = {}
+
+
+def file_hash(path, buffer_size=1 << 20):
+    """ Returns the SHA-1 of the contents of path """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+    if memo_key not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as IN:
+            for chunk in iter(lambda: IN.read(buffer_size), b""):
+                sha.update(chunk)
+
+        _file_hashes[memo_key] = sha.hexdigest()
+
+    return _file_hashes[memo_key]
+
+
+class StepCache(object):
+    """ A directory of step outputs indexed by step key, optionally limited to max_bytes (least recently used go first) """
+
+    # marks a complete entry; its mtime is the last time the entry was used
+    complete_f = "complete"
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def file_hash(self, path, buffer_size=1 << 20):
+        """ Returns the SHA-1 of the contents of path """
+        return file_hash(path, buffer_size)
+
+    def key(self, step, inputs=(), args=(), parents=()):
+        """
+        Returns the key for a step.
+
+        inputs are files whose contents the outputs depend on, args are any other settings that change the
+        outputs (not output paths) and parents are the keys of steps whose outputs this step reads.
+        """
+        description = [step, list(args), [self.file_hash(path) for path in inputs], list(parents)]
+
+        return hashlib.sha1(json.dumps(description).encode("utf-8")).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def has(self, key):
+        return os.path.isfile(os.path.join(self._entry_dir(key), self.complete_f))
+
+    def fetch(self, key, outputs):
+        """ Puts the cached outputs for key at the paths in outputs, replacing anything already there """
+        entry = self._entry_dir(key)
+
+        for indx, output in enumerate(outputs):
+            _remove(output)
+            _link_or_copy(os.path.join(entry, str(indx)), output)
+
+        # mark as recently used
+        os.utime(os.path.join(entry, self.complete_f), None)
+
+    def store(self, key, outputs):
+        """ Stores the files (or directories) in outputs under key """
+        entry = self._entry_dir(key)
+        if self.has(key):
+            return
+
+        # build the entry to the side and move it into place so a half stored entry is never used
+        tmp = entry + ".tmp{}".format(os.getpid())
+        _remove(tmp)
+        os.makedirs(tmp)
+
+        for indx, output in enumerate(outputs):
+            _link_or_copy(output, os.path.join(tmp, str(indx)))
+
+        open(os.path.join(tmp, self.complete_f), 'w').close()
+
+        # an entry already there was just published by another job that stored the same step (and may be
+        # fetching it), so it is kept
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            _remove(tmp)
+
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache is no bigger than max_bytes """
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+
+            for key in os.listdir(prefix_dir):
+                complete = os.path.join(prefix_dir, key, self.complete_f)
+                if os.path.isfile(complete):
+                    entry = os.path.join(prefix_dir, key)
+                    entries.append((os.path.getmtime(complete), _size(entry), entry))
+
+        total = sum(size for last_used, size, entry in entries)
+        for last_used, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            LOG.info("Evicting '{}' from the step cache.".format(entry))
+            _remove(entry)
+            total -= size
+
+    def run(self, key, outputs, command):
+        """ Fetches the outputs if the step is cached, otherwise runs command and stores them. Returns an exit code """
+        if self.has(key):
+            LOG.info("Using cached outputs for step {}.".format(key))
+            self.fetch(key, outputs)
+            return 0
+
+        # outputs may be hard links into cache entries, which the command would rewrite in place
+        for output in outputs:
+            _remove(output)
+
+        exit_code = subprocess.call(command, shell=True)
+
+        if exit_code == 0:
+            missing = [output for output in outputs if not os.path.exists(output)]
+            if missing:
+                LOG.warning("Step {} didn't make {}. Not caching it.".format(key, ", ".join(missing)))
+            else:
+                self.store(key, outputs)
+
+        return exit_code
+
+    def wrap(self, command, key, outputs):
+        """ Returns a shell command that runs command through this cache (using this file as a script) """
+        script = os.path.abspath(__file__)
+        if script.endswith((".pyc", ".pyo")):
+            script = script[:-1]
+
+        wrapped = [sys.executable, script, "-cache_dir", self.cache_dir, "-key", key]
+        if self.max_bytes is not None:
+            wrapped += ["-max_bytes", str(self.max_bytes)]
+
+        for output in outputs:
+            wrapped += ["-output", os.path.abspath(output)]
+
+        wrapped += ["-command", command]
+
+        return " ".join(_quote(arg) for arg in wrapped)
+
+
+def _quote(arg):
+    """ Quotes an argument for a POSIX shell """
+    return "'" + arg.replace("'", "'\"'\"'") + "'"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a PICRUSt workflow step through a content-addressed cache of its outputs")
+    parser.add_argument("-cache_dir", help="the cache directory", required=True)
+    parser.add_argument("-key", help="the key of the step", required=True)
+    parser.add_argument("-max_bytes", help="the maximum size of the cache", type=int, default=None)
+    parser.add_argument("-output", help="a file or directory the step makes", action="append", required=True)
+    parser.add_argument("-command", help="the shell command for the step", required=True)
+
+    args = parser.parse_args()
+
+    cache = StepCache(args.cache_dir, args.max_bytes)
+    sys.exit(cache.run(args.key, args.output, args.command))
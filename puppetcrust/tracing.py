@@ -0,0 +1,273 @@
+
+"""
+Opt-in timing of the stages of a run (parsing tables, submitting and waiting on jobs, scoring...).
+
+Tracing is off unless the PUPPETCRUST_TRACE environment variable is set to an output path (or a
+script is given -trace). Each stage records its wall time, CPU time and memory, and the trace is
+written when the program exits, either as JSON (PUPPETCRUST_TRACE_FORMAT=json, the default) or as
+a Chrome trace that chrome://tracing or Perfetto can open (PUPPETCRUST_TRACE_FORMAT=chrome).
+
+Memory is the peak resident size of the process at the end of each stage. With
+PUPPETCRUST_TRACE_MEMORY=tracemalloc, the peak of Python (and NumPy) allocations during each stage is
+recorded too, which is more precise but slows the run down.
+
+When tracing is off, a traced function costs one extra call and a check of a global.
+"""
+
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+FORMATS = ["json", "chrome"]
+
+
+def _max_rss_mb():
+    """ Returns the peak resident size of the process in MB (or None if it can't be found) """
+    if resource is None:
+        return None
+
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Tracer(object):
+    """ Collects the stages of a run and writes them to out_f """
+
+    def __init__(self, out_f, format="json", memory="rss"):
+        if format not in FORMATS:
+            raise ValueError("Trace format '{}' is invalid.".format(format))
+
+        self.out_f = os.path.abspath(out_f)
+        self.format = format
+
+        self.tracemalloc = memory == "tracemalloc" and tracemalloc is not None
+        if self.tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self.pid = os.getpid()
+        self.origin = time.time()
+        self.origin_counter = time.perf_counter()
+
+        self.stages = []
+        self._lock = threading.Lock()
+
+        # the peaks of the stages open in each thread, so a stage's peak includes its children
+        self._peaks = threading.local()
+
+    def _peak_stack(self):
+        if not hasattr(self._peaks, "stack"):
+            self._peaks.stack = []
+
+        return self._peaks.stack
+
+    def _start_peak(self):
+        stack = self._peak_stack()
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1] = max(stack[-1], peak)
+
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+        stack.append(current)
+
+    def _end_peak(self):
+        stack = self._peak_stack()
+        peak = max(stack.pop(), tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1] = max(stack[-1], peak)
+
+        return peak
+
+    def begin(self):
+        """ Starts measuring a stage. Returns the (wall, cpu) start times to give to end """
+        if self.tracemalloc:
+            self._start_peak()
+
+        return time.perf_counter(), time.process_time()
+
+    def end(self, name, started, details=None):
+        """ Records the stage name that was started with begin """
+        wall, cpu = started
+        stage = {
+                "name": name,
+                "start": wall - self.origin_counter,
+                "wall": time.perf_counter() - wall,
+                "cpu": time.process_time() - cpu,
+                "max_rss_mb": _max_rss_mb(),
+                "thread": threading.current_thread().name
+                }
+
+        if self.tracemalloc:
+            stage["peak_mb"] = self._end_peak() / 1024 ** 2
+
+        if details:
+            stage["args"] = details
+
+        with self._lock:
+            self.stages.append(stage)
+
+    def run(self, name, func, args, kwargs, details=None):
+        """ Calls func(*args, **kwargs) as the stage name. Returns its result """
+        started = self.begin()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.end(name, started, details)
+
+    def summary(self):
+        """ Returns a dict of stage name: {count, wall, cpu} totals """
+        totals = {}
+        for stage in self.stages:
+            total = totals.setdefault(stage["name"], {"count": 0, "wall": 0.0, "cpu": 0.0})
+            total["count"] += 1
+            total["wall"] += stage["wall"]
+            total["cpu"] += stage["cpu"]
+
+        return totals
+
+    def write(self):
+        with self._lock:
+            stages = sorted(self.stages, key=lambda stage: stage["start"])
+
+        if self.format == "chrome":
+            # Chrome wants numeric thread ids, so threads are numbered and named with metadata events
+            threads = {}
+            events = []
+            for stage in stages:
+                if stage["thread"] not in threads:
+                    threads[stage["thread"]] = len(threads)
+                    events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": threads[stage["thread"]], "args": {"name": stage["thread"]}})
+
+                args = dict(stage.get("args", {}))
+                args.update({key: stage[key] for key in ("cpu", "max_rss_mb", "peak_mb") if key in stage})
+
+                events.append({
+                    "name": stage["name"],
+                    "ph": "X",
+                    "ts": stage["start"] * 1e6,
+                    "dur": stage["wall"] * 1e6,
+                    "pid": self.pid,
+                    "tid": threads[stage["thread"]],
+                    "args": args
+                    })
+
+            trace = {"traceEvents": events, "displayTimeUnit": "ms"}
+        else:
+            trace = {"start": self.origin, "pid": self.pid, "stages": stages, "summary": self.summary()}
+
+        with open(self.out_f, 'w') as OUT:
+            json.dump(trace, OUT, indent=1)
+
+        LOG.info("Wrote a trace of {} stages to '{}'.".format(len(stages), self.out_f))
+
+
+# the active Tracer or None when tracing is off
+_tracer = None
+
+
+def enable(out_f, format="json", memory="rss"):
+    """ Starts tracing; the trace is written to out_f when the program exits. Returns the Tracer """
+    global _tracer
+
+    if _tracer is not None:
+        return _tracer
+
+    _tracer = Tracer(out_f, format, memory)
+    atexit.register(_write_at_exit, _tracer)
+
+    return _tracer
+
+
+def _write_at_exit(tracer):
+    # only the process that started the trace writes it (not forked workers)
+    if os.getpid() == tracer.pid:
+        tracer.write()
+
+
+def enabled():
+    return _tracer is not None
+
+
+def traced(name, details=None):
+    """
+    Decorates a function so each call is recorded as the stage name when tracing is on.
+
+    details is an optional function that gets the call's arguments and returns a dict of extra
+    information to record (only called when tracing is on).
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+
+            return _tracer.run(name, func, args, kwargs, details(*args, **kwargs) if details else None)
+
+        return wrapper
+
+    return decorator
+
+
+def argument(position, key="path"):
+    """ Returns a details function for traced that records the argument at position (counting self or cls) as key """
+    def details(*args, **kwargs):
+        return {key: str(args[position])} if len(args) > position else {}
+
+    return details
+
+
+class stage(object):
+    """ A context manager that records the code inside it as a stage when tracing is on """
+
+    def __init__(self, name, **details):
+        self.name = name
+        self.details = details
+
+    def __enter__(self):
+        # the tracer is kept in case tracing is turned on inside the stage
+        self.tracer = _tracer
+        if self.tracer is not None:
+            self.started = self.tracer.begin()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.tracer is not None:
+            self.tracer.end(self.name, self.started, self.details)
+
+        return False
+
+
+def add_arguments(parser):
+    """ Adds the -trace and -trace_format options to a script's argparse parser """
+    parser.add_argument("-trace", help="record the time and memory of each stage of the run to this file (or set PUPPETCRUST_TRACE)", default=None)
+    parser.add_argument("-trace_format", help="format of the -trace file [%(default)s]", choices=FORMATS, default="json")
+
+
+def enable_from_args(args):
+    """ Starts tracing if the script was given -trace """
+    if getattr(args, "trace", None):
+        enable(args.trace, args.trace_format, os.environ.get("PUPPETCRUST_TRACE_MEMORY", "rss"))
+
+
+if os.environ.get("PUPPETCRUST_TRACE"):
+    enable(os.environ["PUPPETCRUST_TRACE"], os.environ.get("PUPPETCRUST_TRACE_FORMAT", "json"), os.environ.get("PUPPETCRUST_TRACE_MEMORY", "rss"))
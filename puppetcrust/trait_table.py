@@ -3,13 +3,34 @@ from __future__ import division
 
 
 import pandas
+import numpy
 import logging
 import math
+import os
+import multiprocessing
+
+from puppetcrust import tracing, sidecar
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# optional; without it matrices are always dense
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
 
 logging.basicConfig()
 LOG = logging.getLogger(__name__)
 
 
+class NonNumericTraitError(ValueError):
+    """ Raised when a table with non-numeric trait values is parsed into a matrix """
+    pass
+
+
 class TraitTableEntry(object):
     """ A single entry in a trait table """
 
@@ -121,12 +142,747 @@ class TraitTableEntry(object):
         else:
             raise ValueError("metric '{}' is invalid.".format(metric))
 
+
+class TraitTableRow(TraitTableEntry):
+    """
+    A lightweight, read-only view of one row of a TraitTableMatrix.
+
+    Behaves like a TraitTableEntry (traits and metadata are mappings) but doesn't copy any values
+    out of the matrix until they are asked for.
+    """
+
+    def __init__(self, matrix, index):
+        self.name = matrix.names[index]
+        self.matrix = matrix
+        self.index = index
+
+        self._traits = None
+
+    @property
+    def traits(self):
+        if self._traits is None:
+            self._traits = _RowTraits(self.matrix, self.index)
+
+        return self._traits
+
+    @property
+    def metadata(self):
+        return {name: column[self.index] for name, column in self.matrix.metadata.items()}
+
+    def add_trait(self, trait, value):
+        raise TypeError("{} is a read-only view of a trait table matrix.".format(str(self)))
+
+
+class _RowTraits(Mapping):
+    """ Maps trait name -> value for a single matrix row. Values are returned as floats like TraitTableEntry """
+
+    def __init__(self, matrix, index):
+        self._trait_index = matrix.trait_index
+        self._traits = matrix.traits
+        self._row = matrix.row_values(index)
+
+    def __getitem__(self, trait):
+        return float(self._row[self._trait_index[trait]])
+
+    def __iter__(self):
+        return iter(self._traits)
+
+    def __len__(self):
+        return len(self._traits)
+
+    def __contains__(self, trait):
+        return trait in self._trait_index
+
+
+class _ColumnLayout(object):
+    """ Splits the columns of a trait table header into matrix traits and metadata """
+
+    def __init__(self, headers):
+        self.headers = headers
+
+        self.traits = []
+        self.trait_columns = []
+        self.metadata = []
+        self.metadata_columns = []
+        for indx, header in enumerate(headers):
+            if header.startswith("metadata_"):
+                name = header.split("metadata_")[1]
+                if name in self.metadata:
+                    raise ValueError("Trait table has a duplicated metadata column called '{}'.".format(name))
+
+                self.metadata.append(name)
+                self.metadata_columns.append(indx)
+            else:
+                if header in self.traits:
+                    raise ValueError("Trait table has a duplicated trait called '{}'.".format(header))
+
+                self.traits.append(header)
+                self.trait_columns.append(indx)
+
+        # no metadata means the values can be converted without picking columns out
+        self.all_traits = len(self.trait_columns) == len(self.headers)
+
+    def split_line(self, line, trait_table_f):
+        """ Returns a tuple (name, trait_values, metadata_values) of strings for a line of the table """
+        fields = line.rstrip("\r\n").split("\t")
+        name = fields[0]
+        values = fields[1:]
+
+        if len(values) != len(self.headers):
+            raise ValueError("Genome '{}' in '{}' has {} values but the header has {} traits.".format(
+                name, trait_table_f, len(values), len(self.headers)))
+
+        if self.all_traits:
+            return name, values, []
+        else:
+            return name, [values[i] for i in self.trait_columns], [values[i] for i in self.metadata_columns]
+
+
+def _parse_lines(lines, layout, trait_table_f):
+    """ Parses a list of lines from a trait table into a float64 TraitTableMatrix. Blank lines are skipped """
+    lines = [line for line in lines if line.strip()]
+
+    names = []
+    values = numpy.empty((len(lines), len(layout.traits)), dtype=numpy.float64)
+    metadata = {name: [] for name in layout.metadata}
+    for row, line in enumerate(lines):
+        name, trait_values, metadata_values = layout.split_line(line, trait_table_f)
+
+        try:
+            values[row] = trait_values
+        except ValueError:
+            raise NonNumericTraitError("Genome '{}' in '{}' has a non-numeric trait value. Use the TraitTableManager iterator for tables like this.".format(name, trait_table_f))
+
+        for md_name, value in zip(layout.metadata, metadata_values):
+            metadata[md_name].append(_convert_metadata(value))
+
+        names.append(name)
+
+    return TraitTableMatrix(names, layout.traits, values, metadata)
+
+
+def _iter_file_blocks(trait_table_f, rows):
+    """ Yields float64 TraitTableMatrix blocks of up to rows rows, parsed from the table in order """
+    with open(trait_table_f, 'r') as IN:
+        layout = _ColumnLayout(IN.readline().rstrip("\r\n").split("\t")[1:])
+
+        block = []
+        for line in IN:
+            # skip blank lines
+            if not line.strip():
+                continue
+
+            block.append(line)
+            if len(block) == rows:
+                yield _parse_lines(block, layout, trait_table_f)
+                block = []
+
+        if block:
+            yield _parse_lines(block, layout, trait_table_f)
+
+
+def _split_byte_ranges(trait_table_f, parts):
+    """ Returns a list of (start, end) byte ranges that split the rows of the table into about parts pieces on line boundaries """
+    size = os.path.getsize(trait_table_f)
+    with open(trait_table_f, 'rb') as IN:
+        header_end = len(IN.readline())
+
+        boundaries = [header_end]
+        step = max(1, (size - header_end) // parts)
+        for approx in range(header_end + step, size, step):
+            # finish the line the approximate boundary fell in
+            IN.seek(max(approx - 1, boundaries[-1]))
+            IN.readline()
+
+            if IN.tell() > boundaries[-1] and IN.tell() < size:
+                boundaries.append(IN.tell())
+
+        boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _parse_byte_range(args):
+    """ Process pool worker that parses one byte range of a table into a float64 TraitTableMatrix """
+    trait_table_f, headers, start, end = args
+
+    with open(trait_table_f, 'rb') as IN:
+        IN.seek(start)
+        lines = IN.read(end - start).decode("utf-8").split("\n")
+
+    return _parse_lines(lines, _ColumnLayout(headers), trait_table_f)
+
+
+def issparse(values):
+    """ Returns True if values is a SciPy sparse matrix """
+    return sparse is not None and sparse.issparse(values)
+
+
+def iter_row_lists(values, block_rows=1024):
+    """ Yields each row of a 2-D array or sparse matrix as a list of floats, only making block_rows rows dense at a time """
+    for start in range(0, values.shape[0], block_rows):
+        block = values[start:start + block_rows]
+        if issparse(block):
+            block = block.toarray()
+
+        for row in block.astype(numpy.float64).tolist():
+            yield row
+
+
+def _format_row(name, row):
+    return "\t".join([name] + [str(value) for value in row]) + "\n"
+
+
+def write_rows(fh, names, values):
+    """ Writes names and the rows of values (dense or sparse) in the same format TraitTableEntry.write uses """
+    for name, row in zip(names, iter_row_lists(values)):
+        fh.write(_format_row(name, row))
+
+
+def _convert_metadata(value):
+    """ Converts metadata the same way TraitTableEntry.add_trait does """
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _narrow_dtype(values, block_rows=4096):
+    """
+    Returns values cast to the smallest integer dtype that holds every value exactly.
+
+    If any value is fractional, non-finite or a negative zero, values is returned unchanged. Sparse
+    matrices have their stored values narrowed.
+    """
+    if issparse(values):
+        return sparse.csr_matrix((_narrow_dtype(values.data, block_rows), values.indices, values.indptr), shape=values.shape)
+
+    if values.size == 0:
+        return values
+
+    # check in blocks so the temporaries stay small
+    for start in range(0, values.shape[0], block_rows):
+        block = values[start:start + block_rows]
+
+        if not numpy.isfinite(block).all():
+            return values
+
+        if not numpy.array_equal(block, numpy.trunc(block)):
+            return values
+
+        if numpy.signbit(block[block == 0]).any():
+            return values
+
+    low = values.min()
+    high = values.max()
+    for dtype in (numpy.uint8, numpy.int8, numpy.uint16, numpy.int16, numpy.uint32, numpy.int32, numpy.int64):
+        info = numpy.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+
+    return values
+
+
+# storage for TraitTableMatrix.from_file; "auto" uses sparse storage for tables no denser than SPARSE_DENSITY
+STORAGES = ["auto", "dense", "sparse"]
+SPARSE_DENSITY = 0.25
+
+
+def _density(values):
+    """ Returns the fraction of values that aren't zero """
+    if not values.size:
+        return 0.0
+
+    return numpy.count_nonzero(values) / values.size
+
+
+# metrics that _row_metric can compute for a whole block of rows at once
+VECTORIZED_METRICS = ["spearman", "disimilarity"]
+METRICS = VECTORIZED_METRICS + ["positivepred"]
+
+def _row_metric(a, b, metric):
+    """
+    Computes metric between each row of a and the same row of b (2-D float arrays of the same shape).
+
+    Gives the same answers as TraitTableEntry.compare on the individual rows.
+    """
+    if metric == "disimilarity":
+        # pandas sums skip NaN but the number of traits still includes them
+        diff = numpy.abs(a - b) ** 2
+        return numpy.sqrt(numpy.nansum(diff, axis=1)) / a.shape[1]
+
+    elif metric == "spearman":
+        # pearson correlation of the ranks (ties get the average rank like pandas)
+        rank_a = pandas.DataFrame(a).rank(axis=1).values
+        rank_b = pandas.DataFrame(b).rank(axis=1).values
+
+        rank_a = rank_a - rank_a.mean(axis=1)[:, None]
+        rank_b = rank_b - rank_b.mean(axis=1)[:, None]
+
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            corr = (rank_a * rank_b).sum(axis=1) / numpy.sqrt((rank_a ** 2).sum(axis=1) * (rank_b ** 2).sum(axis=1))
+
+        # pandas drops NaN pairwise before ranking, redo those rows the slow way
+        for indx in numpy.flatnonzero(numpy.isnan(a).any(axis=1) | numpy.isnan(b).any(axis=1)):
+            df = pandas.DataFrame({"self": a[indx], "other": b[indx]})
+            corr[indx] = df.corr(method="spearman").loc["self", "other"]
+
+        return corr
+
+    else:
+        raise ValueError("metric '{}' can't be vectorized.".format(metric))
+
+
+class TraitTableMatrix(object):
+    """
+    A trait table parsed once into a 2-D NumPy matrix.
+
+    Rows are genomes and columns are the non-metadata traits in table order. Metadata columns are
+    stored separately as lists (indexed by name without the 'metadata_' prefix) because they aren't
+    always numeric. Iterating yields TraitTableRow views that can be used anywhere a TraitTableEntry is.
+
+    Values can also be a SciPy CSR matrix (see from_file) for tables that are mostly zeros.
+    """
+
+    def __init__(self, names, traits, values, metadata=None):
+        self.names = list(names)
+        self.traits = list(traits)
+        self.values = values
+        self.metadata = metadata if metadata is not None else {}
+
+        if self.values.shape != (len(self.names), len(self.traits)):
+            raise ValueError("Matrix shape {} doesn't match {} names and {} traits.".format(
+                self.values.shape, len(self.names), len(self.traits)))
+
+        # if a genome is duplicated the first row is the one found by name
+        self.name_index = {}
+        for indx, name in enumerate(self.names):
+            self.name_index.setdefault(name, indx)
+
+        self.trait_index = {trait: indx for indx, trait in enumerate(self.traits)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name_index
+
+    def __iter__(self):
+        """ Yields a TraitTableRow for each row in the matrix """
+        for indx in range(len(self.names)):
+            yield TraitTableRow(self, indx)
+
+    def get_row(self, name):
+        """ Returns a TraitTableRow for the genome called name. Raises KeyError if it isn't present """
+        return TraitTableRow(self, self.name_index[name])
+
+    @property
+    def is_sparse(self):
+        return issparse(self.values)
+
+    def row_values(self, index):
+        """ Returns a 1-D array of the trait values for the row at index """
+        if self.is_sparse:
+            return self.values[index].toarray().ravel()
+
+        return self.values[index]
+
+    def dense_values(self, rows, columns):
+        """ Returns a float64 array of the values at rows x columns (sequences of indexes) """
+        if self.is_sparse:
+            return self.values[rows][:, columns].toarray().astype(numpy.float64)
+
+        return self.values[numpy.ix_(rows, columns)].astype(numpy.float64)
+
+    def slice(self, start, end):
+        """ Returns a TraitTableMatrix of rows start to end. Dense values are a view, not a copy """
+        metadata = {name: column[start:end] for name, column in self.metadata.items()}
+
+        return TraitTableMatrix(self.names[start:end], self.traits, self.values[start:end], metadata)
+
+    def compare_rows(self, other, metric, names=None, block_rows=1024):
+        """
+        Compares rows of self to the rows with the same name in other using the traits both tables share.
+
+        Uses all the names in self if names is None. Returns a dict of name: value for each name found
+        in both matrices; names missing from either are left out so the caller can decide how to report them.
+        """
+        if metric not in METRICS:
+            raise ValueError("metric '{}' is invalid.".format(metric))
+
+        if names is None:
+            names = self.names
+
+        # align the rows by name
+        matched = [name for name in names if name in self.name_index and name in other.name_index]
+        rows_self = numpy.array([self.name_index[name] for name in matched], dtype=numpy.intp)
+        rows_other = numpy.array([other.name_index[name] for name in matched], dtype=numpy.intp)
+
+        # align the columns by trait
+        shared = [trait for trait in self.traits if trait in other.trait_index]
+        if matched and not shared:
+            raise ValueError("No traits were shared between the entries.")
+
+        cols_self = numpy.array([self.trait_index[trait] for trait in shared], dtype=numpy.intp)
+        cols_other = numpy.array([other.trait_index[trait] for trait in shared], dtype=numpy.intp)
+
+        results = {}
+        for start in range(0, len(matched), block_rows):
+            block_self = rows_self[start:start + block_rows]
+            block_other = rows_other[start:start + block_rows]
+
+            if metric == "disimilarity" and self.is_sparse and other.is_sparse:
+                # the differences of sparse rows stay sparse. Values may be narrowed integers, which would wrap
+                a = self.values[block_self][:, cols_self].astype(numpy.float64)
+                b = other.values[block_other][:, cols_other].astype(numpy.float64)
+                diff = a - b
+                diff = diff.multiply(diff)
+
+                scores = _nansum_rows(diff) ** 0.5 / len(shared)
+                scores = scores.tolist()
+
+            elif metric in VECTORIZED_METRICS:
+                a = self.dense_values(block_self, cols_self)
+                b = other.dense_values(block_other, cols_other)
+
+                scores = _row_metric(a, b, metric).tolist()
+            else:
+                scores = [TraitTableRow(self, s).compare(TraitTableRow(other, o), metric=metric, traits=shared)
+                          for s, o in zip(block_self, block_other)]
+
+            for name, score in zip(matched[start:start + block_rows], scores):
+                results[name] = score
+
+        return results
+
+    @classmethod
+    @tracing.traced("trait_table.parse", tracing.argument(1))
+    def from_file(cls, trait_table_f, narrow=True, processes=1, storage="auto"):
+        """
+        Parses a trait table into a matrix.
+
+        If narrow is True and all the traits are integer counts, the matrix is stored using the smallest
+        integer dtype that holds them. Raises a ValueError if a trait (non-metadata) value is not a number.
+
+        With processes > 1, the table is split into line-aligned byte ranges that are parsed in a process
+        pool and stitched back together in table order. The result is identical to the serial parse.
+
+        storage is one of STORAGES. Sparse matrices (which need SciPy) are built a block at a time so the
+        dense table is never held in memory; "auto" picks sparse storage if the first block is no denser
+        than SPARSE_DENSITY. Negative zeros aren't kept in sparse storage.
+        """
+        if storage not in STORAGES:
+            raise ValueError("storage '{}' is invalid.".format(storage))
+
+        if storage != "dense" and sparse is None:
+            if storage == "sparse":
+                raise ValueError("Sparse storage needs SciPy, which can't be imported.")
+
+            storage = "dense"
+
+        with open(trait_table_f, 'r') as IN:
+            headers = IN.readline().rstrip("\r\n").split("\t")[1:]
+            layout = _ColumnLayout(headers)
+
+            # count rows so the matrix can be allocated once
+            if processes > 1:
+                num_rows = None
+            else:
+                num_rows = sum(1 for line in IN if line.strip())
+
+        if processes > 1:
+            # several ranges per process evens out the load when rows differ in length
+            ranges = _split_byte_ranges(trait_table_f, processes * 4)
+
+            pool = multiprocessing.Pool(processes)
+            try:
+                blocks = pool.map(_parse_byte_range, [(trait_table_f, headers, start, end) for start, end in ranges])
+            finally:
+                pool.close()
+                pool.join()
+
+            num_rows = sum(len(block) for block in blocks)
+        else:
+            blocks = _iter_file_blocks(trait_table_f, rows=4096)
+
+        names = []
+        values = None
+        sparse_blocks = []
+        metadata = {name: [] for name in layout.metadata}
+        for block in blocks:
+            if storage == "auto":
+                storage = "sparse" if _density(block.values) <= SPARSE_DENSITY else "dense"
+
+            if storage == "sparse":
+                sparse_blocks.append(sparse.csr_matrix(block.values))
+            else:
+                if values is None:
+                    values = numpy.empty((num_rows, len(layout.traits)), dtype=numpy.float64)
+
+                values[len(names):len(names) + len(block)] = block.values
+
+            names.extend(block.names)
+
+            for md_name in layout.metadata:
+                metadata[md_name].extend(block.metadata[md_name])
+
+        # drop the parsed blocks before narrowing makes another copy
+        blocks = None
+
+        if sparse_blocks:
+            values = sparse.vstack(sparse_blocks, format="csr")
+            sparse_blocks = None
+        elif values is None:
+            values = numpy.empty((0, len(layout.traits)), dtype=numpy.float64)
+
+        if narrow:
+            values = _narrow_dtype(values)
+
+        LOG.info("Loaded {} genomes x {} traits from '{}' as {}{}.".format(len(names), len(layout.traits), trait_table_f, values.dtype, " (sparse)" if issparse(values) else ""))
+
+        return cls(names, layout.traits, values, metadata)
+
+
+def _nansum_rows(values):
+    """ Returns the sums of the rows of a sparse matrix ignoring NaN like numpy.nansum """
+    values = values.tocsr(copy=True)
+    values.data[numpy.isnan(values.data)] = 0
+
+    return numpy.asarray(values.sum(axis=1)).ravel()
+
+
+def _sidecar_path(trait_table_f, cache_dir, suffix):
+    """ Returns the path of a sidecar file for trait_table_f. Sidecars go next to the table unless cache_dir is given """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(trait_table_f))
+
+    return os.path.join(cache_dir, os.path.basename(trait_table_f) + suffix)
+
+
+class TraitTableCache(object):
+    """
+    A binary sidecar for a trait table so it only has to be parsed from text once.
+
+    The matrix is stored as a .npy file that is memory-mapped when loaded (or, for sparse matrices, as
+    the CSR arrays in a .npz file) and the names, traits and metadata are stored in a JSON index along
+    with the key of the source table. A cache whose key doesn't match the table (or that can't be read)
+    is treated as missing and rebuilt.
+    """
+
+    version = 3
+
+    def __init__(self, trait_table_f, cache_dir=None, storage="auto"):
+        self.trait_table_f = trait_table_f
+
+        # storage for TraitTableMatrix.from_file; a cache with different storage is rebuilt unless this is "auto"
+        self.storage = storage
+
+        self.values_f = _sidecar_path(trait_table_f, cache_dir, ".cache.npy")
+        self.sparse_f = _sidecar_path(trait_table_f, cache_dir, ".cache.npz")
+        self.index_f = _sidecar_path(trait_table_f, cache_dir, ".cache.json")
+
+    @tracing.traced("trait_table.cache_load", lambda self: {"path": self.trait_table_f})
+    def load(self):
+        """ Returns a TraitTableMatrix backed by the memory-mapped cache or None if the cache is missing, stale or corrupt """
+        index = sidecar.load(self.index_f, self.version, sidecar.file_key(self.trait_table_f), "Cache")
+        if index is None:
+            return None
+
+        try:
+            if self.storage != "auto" and index["storage"] != self.storage:
+                LOG.info("Cache '{}' isn't {}. Rebuilding.".format(self.index_f, self.storage))
+                return None
+
+            if index["storage"] == "sparse":
+                if sparse is None:
+                    LOG.info("Cache '{}' is sparse but SciPy can't be imported. Rebuilding.".format(self.index_f))
+                    return None
+
+                with numpy.load(self.sparse_f) as arrays:
+                    values = sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(index["shape"]))
+            else:
+                values = numpy.load(self.values_f, mmap_mode="r")
+
+            if list(values.shape) != index["shape"] or str(values.dtype) != index["dtype"]:
+                raise ValueError("matrix doesn't match the index")
+
+            return TraitTableMatrix(index["names"], index["traits"], values, index["metadata"])
+
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            LOG.warning("Cache '{}' is corrupt ({}). Rebuilding.".format(self.index_f, e))
+            return None
+
+    @tracing.traced("trait_table.cache_save", lambda self, matrix, key: {"path": self.trait_table_f})
+    def save(self, matrix, key):
+        """ Writes matrix to the cache. key is the sidecar.file_key of the table when it was parsed """
+        index = {
+                "shape": list(matrix.values.shape),
+                "dtype": str(matrix.values.dtype),
+                "storage": "sparse" if matrix.is_sparse else "dense",
+                "names": matrix.names,
+                "traits": matrix.traits,
+                "metadata": matrix.metadata
+                }
+
+        if matrix.is_sparse:
+            files = {self.sparse_f: lambda OUT: numpy.savez(OUT, data=matrix.values.data, indices=matrix.values.indices, indptr=matrix.values.indptr)}
+        else:
+            files = {self.values_f: lambda OUT: numpy.save(OUT, numpy.ascontiguousarray(matrix.values))}
+
+        sidecar.save(self.index_f, self.version, key, index, "Cache", files)
+
+    def load_or_build(self, processes=1):
+        """ Returns the cached matrix, parsing the table and writing the cache first if necessary """
+        matrix = self.load()
+
+        if matrix is None:
+            key = sidecar.file_key(self.trait_table_f)
+            matrix = TraitTableMatrix.from_file(self.trait_table_f, processes=processes, storage=self.storage)
+            self.save(matrix, key)
+
+        return matrix
+
+
+class TraitTableOffsets(object):
+    """
+    An index of the byte range of every row in a trait table so rows can be read without parsing the rest.
+
+    Rows are kept in table order (duplicated names keep all their rows). The index can be saved as a JSON
+    sidecar keyed like TraitTableCache so it only has to be built once per table.
+    """
+
+    version = 2
+
+    def __init__(self, names, starts, ends, header_end, file_size):
+        self.names = list(names)
+        self.starts = list(starts)
+        self.ends = list(ends)
+        self.header_end = header_end
+        self.file_size = file_size
+
+        self.rows_by_name = {}
+        for indx, name in enumerate(self.names):
+            self.rows_by_name.setdefault(name, []).append(indx)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows_by_name
+
+    @classmethod
+    def from_file(cls, trait_table_f):
+        """ Builds the index with a single byte scan of the table (no values are converted) """
+        with open(trait_table_f, 'rb') as IN:
+            header_end = len(IN.readline())
+
+        offsets = cls([], [], [], header_end, header_end)
+        offsets.extend(trait_table_f)
+
+        return offsets
+
+    def extend(self, trait_table_f):
+        """ Indexes the rows appended to the table since it was indexed (everything after file_size). Returns the number of rows added """
+        added = 0
+        with open(trait_table_f, 'rb') as IN:
+            IN.seek(self.file_size)
+            offset = self.file_size
+
+            for line in IN:
+                # skip blank lines
+                if line.strip():
+                    name = line.split(b"\t", 1)[0].rstrip(b"\r\n").decode("utf-8")
+                    self.rows_by_name.setdefault(name, []).append(len(self.names))
+                    self.names.append(name)
+                    self.starts.append(offset)
+                    self.ends.append(offset + len(line))
+                    added += 1
+
+                offset += len(line)
+
+        self.file_size = offset
+
+        return added
+
+    @classmethod
+    def load_or_build(cls, trait_table_f, cache_dir=None, persist=True):
+        """ Returns the saved index for the table if it is current, otherwise builds it (saving it if persist is True) """
+        key = sidecar.file_key(trait_table_f)
+
+        saved = sidecar.load(cls._index_path(trait_table_f, cache_dir), cls.version, key, "Offset index")
+        if saved is not None:
+            return cls(saved["names"], saved["starts"], saved["ends"], saved["header_end"], key["size"])
+
+        offsets = cls.from_file(trait_table_f)
+
+        if persist:
+            offsets.save(trait_table_f, cache_dir, key)
+
+        return offsets
+
+    @staticmethod
+    def _index_path(trait_table_f, cache_dir=None):
+        return _sidecar_path(trait_table_f, cache_dir, ".offsets.json")
+
+    def save(self, trait_table_f, cache_dir=None, key=None):
+        """ Saves the index as the sidecar of trait_table_f. key is the table's sidecar.file_key when it was indexed (now if None) """
+        if key is None:
+            key = sidecar.file_key(trait_table_f)
+
+        saved = {"names": self.names, "starts": self.starts, "ends": self.ends, "header_end": self.header_end}
+        sidecar.save(self._index_path(trait_table_f, cache_dir), self.version, key, saved, "Offset index")
+
+    def rows(self, names):
+        """ Returns the sorted row numbers of all rows with a name in names """
+        rows = []
+        for name in names:
+            rows.extend(self.rows_by_name.get(name, []))
+
+        return sorted(set(rows))
+
+    def ranges(self, names, remove=False):
+        """
+        Returns a list of (start, end) byte ranges holding the rows in names (or all the other rows if remove is True).
+
+        Adjacent rows are merged into a single range. With remove, the ranges are the stretches of the file
+        between the excluded rows.
+        """
+        ranges = []
+        if remove:
+            start = self.header_end
+            for row in self.rows(names):
+                if self.starts[row] > start:
+                    ranges.append((start, self.starts[row]))
+                start = self.ends[row]
+
+            if self.file_size > start:
+                ranges.append((start, self.file_size))
+        else:
+            for row in self.rows(names):
+                if ranges and ranges[-1][1] == self.starts[row]:
+                    ranges[-1] = (ranges[-1][0], self.ends[row])
+                else:
+                    ranges.append((self.starts[row], self.ends[row]))
+
+        return ranges
+
+
 class TraitTableManager(object):
     """ A class for parsing and manipulating trait tables """
 
-    def __init__(self, trait_table_f):
+    def __init__(self, trait_table_f, in_memory=False, cache=False, cache_dir=None, processes=1, storage="auto"):
         self.trait_table_f = trait_table_f
 
+        # number of processes used to parse the table when it is loaded
+        self.processes = processes
+
+        # how the loaded matrix is stored (see TraitTableMatrix.from_file)
+        self.storage = storage
+
+        # use a binary sidecar (see TraitTableCache) instead of parsing the text
+        self.cache = cache
+        self.cache_dir = cache_dir
+
         # get headers
         with open(self.trait_table_f, 'r') as IN:
             headers = IN.readline().rstrip().split("\t")
@@ -135,9 +891,50 @@ class TraitTableManager(object):
             self.entry_header = headers[0].replace("#", "")
             self.traits = headers[1:]
 
+        # the columns of the matrices from iter_chunks (metadata isn't numeric so it is left out)
+        self.value_traits = [trait for trait in self.traits if not trait.startswith("metadata_")]
+
+        # set by load() and get_offsets()
+        self.matrix = None
+        self.offsets = None
+        if in_memory:
+            self.load()
+
+    def load(self):
+        """
+        Parses the whole table into a TraitTableMatrix (once) and returns it.
+
+        After loading, iteration yields lightweight row views from the matrix instead of reparsing the file.
+        If the manager was made with cache=True, the matrix comes from (and is saved to) a binary sidecar.
+        """
+        if self.matrix is None:
+            if self.cache:
+                self.matrix = TraitTableCache(self.trait_table_f, self.cache_dir, self.storage).load_or_build(self.processes)
+            else:
+                self.matrix = TraitTableMatrix.from_file(self.trait_table_f, processes=self.processes, storage=self.storage)
+
+        return self.matrix
+
+    def _load_cached(self):
+        """ Loads the table if the manager uses a cache (a cached table is always cheaper to map than to parse) """
+        if self.matrix is None and self.cache:
+            try:
+                self.load()
+            except NonNumericTraitError as e:
+                LOG.warning("{} Not caching '{}'.".format(e, self.trait_table_f))
+                self.cache = False
+
     def __iter__(self):
         """ Yields a TraitTableEntry for each line in a trait table """
 
+        self._load_cached()
+
+        if self.matrix is not None:
+            for row in self.matrix:
+                yield row
+
+            return
+
         with open(self.trait_table_f, 'r') as IN:
             # skip header line
             IN.readline()
@@ -147,42 +944,108 @@ class TraitTableManager(object):
                 if not line:
                     continue
 
-                try:
-                    name, trait_values = line.rstrip().split("\t", 1)
-                except ValueError:
-                    print((line,))
+                yield self._parse_entry(line)
+
+    def iter_chunks(self, rows=10000):
+        """
+        Yields (names, values) for blocks of up to rows rows in table order.
+
+        values is always a dense float64 NumPy array whose columns are the value_traits, however the table is
+        stored. Only one block is held at a time.
+        """
+        for block in self.iter_blocks(rows):
+            values = block.values
+            if issparse(values):
+                values = values.toarray()
+
+            yield block.names, values.astype(numpy.float64, copy=False)
+
+    def iter_blocks(self, rows=10000):
+        """
+        Like iter_chunks but yields TraitTableMatrix blocks so the metadata comes along too.
+
+        The values of the blocks are kept as the table is stored, so a loaded or cached table can give sparse
+        or narrowed integer blocks (views of the loaded matrix). Use dense_values for float64 values.
+        """
+        self._load_cached()
 
-                tte = TraitTableEntry(name)
+        if self.matrix is not None:
+            for start in range(0, len(self.matrix), rows):
+                yield self.matrix.slice(start, start + rows)
+        else:
+            for block in _iter_file_blocks(self.trait_table_f, rows):
+                yield block
+
+    def _parse_entry(self, line):
+        """ Makes a TraitTableEntry from a line of the table """
+        try:
+            name, trait_values = line.rstrip().split("\t", 1)
+        except ValueError:
+            print((line,))
+
+        tte = TraitTableEntry(name)
 
-                # add all traits
-                for index, val in enumerate(trait_values.split("\t")):
-                    tte.add_trait(self.traits[index], val)
+        # add all traits
+        for index, val in enumerate(trait_values.split("\t")):
+            tte.add_trait(self.traits[index], val)
 
-                yield tte
+        return tte
+
+    def get_offsets(self):
+        """ Returns the TraitTableOffsets for the table, building it once. It is saved as a sidecar if the manager uses a cache """
+        if self.offsets is None:
+            self.offsets = TraitTableOffsets.load_or_build(self.trait_table_f, self.cache_dir, persist=self.cache)
+
+        return self.offsets
 
     @classmethod
+    @tracing.traced("trait_table.compare")
     def compare_two_tables(cls, tab1, tab2, to_compare=None, metric="disimilarity"):
-        """ This is a convenience method that compares the entries in the list to_compare (all from tab1 if is None) from the two trait tables. Returns a dict indexed by the names in to_compare """
+        """
+        This is a convenience method that compares the entries in the list to_compare (all from tab1 if is None) from the two trait tables. Returns a dict indexed by the names in to_compare
+
+        Tables can be paths or TraitTableManagers. Each table is loaded once, rows are joined by genome
+        name and the metric is computed for all matched genomes together.
+        """
 
         # Open up a manager for each table.
-        # should do a simple check here to allow users to sumbit ttm's as well as files
-        ttm1 = cls(tab1)
-        ttm2 = cls(tab2)
+        ttm1 = tab1 if isinstance(tab1, TraitTableManager) else cls(tab1)
+        ttm2 = tab2 if isinstance(tab2, TraitTableManager) else cls(tab2)
+
+        # table 2 needs random access by name; table 1 is streamed through in chunks
+        matrix2 = ttm2.load()
 
-        # get a list of entries from the first table for quick comparisons
         if to_compare is None:
             LOG.info("Using all the entries from table 1 for the comparision.")
-            comp_entries = [entry for entry in ttm1]
         else:
+            to_compare = set(to_compare)
 
-            comp_entries = [entry for entry in ttm1 if entry.name in to_compare]
-            
-            # check for names not found in table 1
-            entry_names = [entry.name for entry in comp_entries]
-            missing = []
-            for name in to_compare:
-                if name not in entry_names:
-                    missing.append(name)
+        results = {}
+        failed = []
+        for block in ttm1.iter_blocks(rows=10000):
+            if to_compare is None:
+                comp_names = block.names
+            else:
+                comp_names = [name for name in block.names if name in to_compare]
+
+            scores = block.compare_rows(matrix2, metric, comp_names)
+
+            for name in comp_names:
+                if name not in scores:
+                    failed.append(name)
+                    continue
+
+                results[name] = {metric: scores[name]}
+
+                # try to get a NSTI value
+                for matrix in (block, matrix2):
+                    if "NSTI" in matrix.metadata:
+                        results[name]["NSTI"] = matrix.metadata["NSTI"][matrix.name_index[name]]
+                        break
+
+        # check for names not found in table 1
+        if to_compare is not None:
+            missing = [name for name in to_compare if name not in results and name not in failed]
 
             if missing:
                 print("Missing Names:")
@@ -193,29 +1056,12 @@ class TraitTableManager(object):
             else:
                 LOG.info("Found all names from to_compare in table 1.")
 
-        results = {entry.name: None for entry in comp_entries}
-        for comp in comp_entries:
-            for comp2 in ttm2:
-                if comp.name == comp2.name:
-                    results[comp.name] = {metric: comp.compare(comp2, metric=metric)}
-
-                    # try to get a NSTI value
-                    try:
-                        results[comp.name]["NSTI"] = comp.metadata["NSTI"]
-                    except KeyError:
-                        try:
-                            results[comp.name]["NSTI"] = comp2.metadata["NSTI"]
-                        except KeyError:
-                            pass
-
-
         # make sure all genomes were compared successfully
-        for genome in results:
-            if results[genome] is None:
-                raise ValueError("Calculation failed for genome '{}'".format(genome))
+        if failed:
+            raise ValueError("Calculation failed for genome '{}'".format(failed[0]))
 
         return results
-    
+
     def get_ordered_traits(self, metadata_last=True):
         """ Returns an ordered list of traits by a natural sort algorithm that optionally sends metadata to the back. """
 
@@ -241,42 +1087,168 @@ class TraitTableManager(object):
     def get_subset(self, subset_names, remove=False):
         """
         A filter around the iter method that only gets entries in the subset_names list (or removes them)
+
+        Entries come out in table order. Unless the table is loaded in memory, the offset index is used to
+        seek straight to the wanted rows (or to read the stretches between the removed rows) so the rest
+        of the table is never decoded.
         """
+        subset_names = set(subset_names)
 
-        to_find = len(subset_names)
-        found = 0
-        for entry in self:
+        if self.matrix is not None:
+            for entry in self:
+                if (entry.name in subset_names) != remove:
+                    yield entry
 
+            return
 
-            # check if we have exhausted the list to speed up the search
-            if found == to_find:
-                if remove:
-                    yield entry
-                    continue
-                else:
-                    return
+        offsets = self.get_offsets()
+        with open(self.trait_table_f, 'rb') as IN:
+            for start, end in offsets.ranges(subset_names, remove):
+                IN.seek(start)
+                while IN.tell() < end:
+                    line = IN.readline()
 
-            if entry.name in subset_names:
-                found += 1
+                    # skip blank lines
+                    if line.strip():
+                        yield self._parse_entry(line.decode("utf-8"))
 
-                if not remove:
-                    yield entry
-            else:
-                if remove:
-                    yield entry
+    @tracing.traced("trait_table.copy_subset", tracing.argument(1))
+    def copy_subset(self, path, subset_names, remove=False, buffer_size=1 << 20):
+        """
+        Copies the header and the rows in subset_names (or all but them) to path byte for byte.
+
+        Unlike write_subset the rows aren't reformatted, so this never parses a value. Returns a list of
+        the names copied.
+        """
+        offsets = self.get_offsets()
+        subset_names = set(subset_names)
+
+        with open(self.trait_table_f, 'rb') as IN, open(path, 'wb') as OUT:
+            OUT.write(IN.read(offsets.header_end))
 
+            for start, end in offsets.ranges(subset_names, remove):
+                IN.seek(start)
+                remaining = end - start
+                while remaining:
+                    chunk = IN.read(min(remaining, buffer_size))
+                    OUT.write(chunk)
+                    remaining -= len(chunk)
+
+        return [name for name in offsets.names if (name in subset_names) != remove]
+
+    @tracing.traced("trait_table.write_subset", tracing.argument(1))
     def write_subset(self, path, subset_names, remove=False):
         """
         Write a new trait table including only a subset of the main one
+
+        Small subsets are pulled out through get_subset. Removing a subset (or writing from a loaded table)
+        goes through iter_chunks so no TraitTableEntry is made for each row.
         """
 
         written = []
         with open(path, 'w') as OUT:
             # write headers
             OUT.write("\t".join(["OTU"] + self.traits) + "\n")
-            
-            for entry in self.get_subset(subset_names, remove):
+
+            if remove or self.matrix is not None or self.cache:
+                subset_names = set(subset_names)
+
+                # entries have no metadata traits so TraitTableEntry.write skips those columns
+                if len(self.value_traits) != len(self.traits):
+                    LOG.warning("Metadata columns can't be written with the traits and will be missing from '{}'.".format(path))
+
+                try:
+                    for names, values in self.iter_chunks():
+                        keep = [indx for indx, name in enumerate(names) if (name in subset_names) != remove]
+
+                        names = [names[indx] for indx in keep]
+                        write_rows(OUT, names, values[keep])
+                        written.extend(names)
+                    return written
+
+                except NonNumericTraitError:
+                    LOG.info("'{}' has non-numeric traits. Writing the subset entry by entry.".format(self.trait_table_f))
+
+            # pick up after any rows the chunks already wrote
+            for indx, entry in enumerate(self.get_subset(subset_names, remove)):
+                if indx < len(written):
+                    continue
+
                 written.append(entry.name)
                 entry.write(OUT, self.traits)
             
             return written
+
+    @tracing.traced("trait_table.write_subsets")
+    def write_subsets(self, subsets, remove=False, max_open=256):
+        """
+        Writes many subsets of the table, each exactly like write_subset would, reading the table once.
+
+        subsets is a list of (path, subset_names). Each row is formatted once and written to every path
+        whose subset has it (or doesn't, with remove). At most max_open files are written per pass over the
+        table. Returns a list of the names written to each path.
+        """
+        subsets = [(path, set(names)) for path, names in subsets]
+
+        # write_subset seeks to small subsets one at a time, which is cheaper than reading the whole table
+        if not (remove or self.matrix is not None or self.cache):
+            return [self.write_subset(path, names, remove) for path, names in subsets]
+
+        written = []
+        for start in range(0, len(subsets), max_open):
+            written.extend(self._write_subsets_pass(subsets[start:start + max_open], remove))
+
+        return written
+
+    def _write_subsets_pass(self, subsets, remove):
+        """ Writes all of subsets (a list of (path, set of names)) in one pass over the table """
+
+        # the subsets each name is in
+        membership = {}
+        for indx, (path, names) in enumerate(subsets):
+            for name in names:
+                membership.setdefault(name, []).append(indx)
+
+        # the outputs a row goes to, by the subsets its name is in
+        targets = {}
+
+        written = [[] for _ in subsets]
+        handles = []
+        try:
+            for path, names in subsets:
+                OUT = open(path, 'w')
+                handles.append(OUT)
+                OUT.write("\t".join(["OTU"] + self.traits) + "\n")
+
+                # entries have no metadata traits so TraitTableEntry.write skips those columns
+                if len(self.value_traits) != len(self.traits):
+                    LOG.warning("Metadata columns can't be written with the traits and will be missing from '{}'.".format(path))
+
+            for names, values in self.iter_chunks():
+                lines = [[] for _ in subsets]
+                for name, row in zip(names, iter_row_lists(values)):
+                    members = tuple(membership.get(name, ()))
+                    if members not in targets:
+                        targets[members] = [indx for indx in range(len(subsets)) if (indx in members) != remove]
+
+                    line = _format_row(name, row)
+                    for indx in targets[members]:
+                        lines[indx].append(line)
+                        written[indx].append(name)
+
+                for OUT, to_write in zip(handles, lines):
+                    OUT.write("".join(to_write))
+
+        except NonNumericTraitError:
+            LOG.info("'{}' has non-numeric traits. Writing each subset entry by entry.".format(self.trait_table_f))
+
+            for OUT in handles:
+                OUT.close()
+
+            return [self.write_subset(path, names, remove) for path, names in subsets]
+
+        finally:
+            for OUT in handles:
+                OUT.close()
+
+        return written
@@ -0,0 +1,25 @@
+
+import argparse
+
+from puppetcrust import database
+
+parser = argparse.ArgumentParser(description="Loads marker FASTA files and trait tables into a genome catalog that create_picrust_database.py can build custom databases from (with -catalog) without rereading the files. Adds to the catalog if it already exists; genomes already in it are skipped")
+parser.add_argument("-catalog", help="the catalog file to make or add to", required=True)
+parser.add_argument("-fasta", help="zero or more marker FASTA files. Header should be genome name", nargs="+", default=[])
+parser.add_argument("-traits", help="zero or more trait tables. First column should be genome names. Tables should all have the same traits", nargs="+", default=[])
+parser.add_argument("-cache", help="reuse (or write) a binary cache of each trait table next to it", action="store_true")
+
+
+args = parser.parse_args()
+
+dbm = database.DatabaseManager(cache=args.cache)
+
+for f in args.fasta:
+    dbm.add_fasta(f)
+
+for t in args.traits:
+    dbm.add_trait_table(t)
+
+catalog = dbm.build_catalog(args.catalog)
+print("The catalog has {} genomes with both markers and traits.".format(len(catalog)))
+catalog.close()
@@ -1,8 +1,18 @@
 
 import argparse
+import os
 import pandas
+import numpy
 import logging
 
+from puppetcrust.kegg import KOHierarchy
+
+# optional; without it the KO to pathway matrix is dense
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
 logging.basicConfig()
 LOG = logging.getLogger(__name__)
 
@@ -18,90 +28,109 @@ def map_ko_to_function(ko_metadata_f, level=2):
     header
     ko\tdescription\tlvl1;lvl2;lvl3|lvl1;lvl2;lvl3|......
 
+    The file is compiled into a KOHierarchy once and cached next to it.
+    """
+    return KOHierarchy.load(ko_metadata_f).ko_to_pathways(level)
+
+
+def membership_matrix(kos, ko_to_functional, warn=True):
     """
-    if level not in [1, 2, 3]:
-        raise ValueError("Level must be 1, 2, or 3.")
+    Returns (pathways, matrix) where matrix is a pathways x kos matrix of the number of times each KO is
+    assigned to each (sorted) pathway.
 
-    ko_to_functional = {}
-    with open(ko_metadata_f, 'r') as IN:
-        # skip header line
-        IN.readline()
+    KOs missing from ko_to_functional are assigned to 'unknown' if they look like KOs and left out
+    otherwise. The matrix is sparse if SciPy can be imported.
+    """
+    pathway_names = []
+    columns = []
+    for col, ko in enumerate(kos):
+        try:
+            paths = ko_to_functional[ko]
+        except KeyError:
+            if str(ko).startswith("K"):
+                if warn:
+                    LOG.warning("{} was not present in KO metadata file, possibly because the pathway is unknown. Adding as 'unknown'".format(ko))
+                paths = ["unknown"]
+            else:
+                if warn:
+                    LOG.warning("{} was not present in KO metadata file and doesn't appear to be a KO. It will be omitted from analysis.".format(ko))
+                continue
 
-        for line in IN:
-            ko_name, ko_description, ko_pathways = line.rstrip().split("\t")
+        # a KO can be in several pathways (or listed more than once in the same one); it counts toward each
+        for path in paths:
+            pathway_names.append(path)
+            columns.append(col)
 
-            # multiple pathways sep by "|"
-            for pathway in ko_pathways.split("|"):
-                levels = pathway.split(";")
+    pathways = sorted(set(pathway_names))
+    positions = {path: indx for indx, path in enumerate(pathways)}
+    rows = [positions[path] for path in pathway_names]
 
-                try:
-                    ko_to_functional[ko_name].append(";".join(levels[:level]))
-                except KeyError:
-                    ko_to_functional[ko_name] = [(";".join(levels[:level]))]
-                except IndexError:
-                    LOG.warning("{} did not have a pathway at the requested level.".format(ko_name))
+    if sparse is not None:
+        # duplicate entries are summed
+        matrix = sparse.coo_matrix((numpy.ones(len(rows), dtype=numpy.int64), (rows, columns)), shape=(len(pathways), len(kos))).tocsr()
+    else:
+        matrix = numpy.zeros((len(pathways), len(kos)), dtype=numpy.int64)
+        numpy.add.at(matrix, (rows, columns), 1)
 
-    return ko_to_functional
+    return pathways, matrix
 
 
-def collapse_kos(table_f, ko_to_functional, orient, out_f):
-    
-    collapsed_counts = {}
+def collapse_kos(table_f, ko_to_functionals, orient, out_fs):
+    """
+    Sums the KOs in a table by pathway. The table is read once and collapsed for each level.
 
-    df = pandas.DataFrame.from_csv(table_f, sep="\t", header=0, index_col=0)
+    ko_to_functionals and out_fs are dicts indexed by level of the dict from map_ko_to_function and the
+    path to write the collapsed table for that level to.
+    """
+    df = pandas.read_csv(table_f, sep="\t", header=0, index_col=0)
 
+    # text columns (descriptions, taxonomy...) can't be summed
+    numeric = df.select_dtypes("number")
+    dropped = [col for col in df.columns if col not in numeric.columns]
+    if dropped:
+        LOG.warning("Skipping columns that aren't numeric: {}".format(", ".join(str(col) for col in dropped)))
+        df = numeric
 
     if orient == "cols":
         df = df.transpose()
-   
-    new_df = df
-    metadata_path = []
-    extra_rows = []     # metadata for the extra rows added at the end for KOs with multiple pathways
-    for indx in list(df.index):
-        try:
-            paths = ko_to_functional[indx]
-        except KeyError:
-            if indx[0] == "K":
-                LOG.warning("{} was not present in KO metadata file, possibly because the pathway is unknown. Adding as 'unknown'".format(indx))
-                metadata_path.append("unknown")
-            else:
-                LOG.warning("{} was not present in KO metadata file and doesn't appear to be a KO. It will be omitted from analysis.".format(indx))
-                metadata_path.append("omit")
-
-            continue
-
-        # add the metadata
-        if len(paths) > 1:
-            # add a new duplicate row for each additional path
-            for path in paths[1:]:
-                new_df = new_df.append(df.loc[indx, :], ignore_index=True)
-                extra_rows.append(path)
-            
-        metadata_path.append(paths[0])
-
-    new_df["ko_pathway"] = metadata_path + extra_rows
-
-    new_df = new_df.groupby("ko_pathway", axis=0).sum() 
-    try:
-        new_df.drop("omit", axis=0, inplace=True)
-    except ValueError:
-        pass
-    
-    if orient == "cols":
-        new_df = new_df.transpose()
 
-    new_df.to_csv(out_f, sep="\t")
+    # missing counts are skipped by the sums
+    values = df.fillna(0).values
+
+    for indx, level in enumerate(sorted(ko_to_functionals)):
+        # only warn about unknown KOs once
+        pathways, matrix = membership_matrix(list(df.index), ko_to_functionals[level], warn=indx == 0)
+
+        collapsed = pandas.DataFrame(matrix.dot(values), index=pandas.Index(pathways, name="ko_pathway"), columns=df.columns)
+
+        if orient == "cols":
+            collapsed = collapsed.transpose()
+
+        collapsed.to_csv(out_fs[level], sep="\t")
+
+
+def level_paths(out_f, levels):
+    """ Returns a dict of level: output path. With several levels, '.level<N>' is added before the extension of out_f """
+    if len(levels) == 1:
+        return {levels[0]: out_f}
+
+    root, ext = os.path.splitext(out_f)
+    return {level: "{}.level{}{}".format(root, level, ext) for level in levels}
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="This is a fairly inefficient program because I had forgotten that each KO could be assigned to multiple pathways. The correction for that involved adding duplicate rows to the dataframe to represent each categorization. However, this is a really computationally expensive way of doing things")
+    parser = argparse.ArgumentParser(description="Sums the KOs in a table by their KEGG pathways at one or more levels. KOs in several pathways count toward each of them")
     parser.add_argument("-table", help="a table with kos in either the rows or columns", required=True)
     parser.add_argument("-ko_metadata", help="a file with information about each KO", required=True)
     parser.add_argument("-orient", help="the orientation the KOs are in", choices=["rows", "cols"], default="rows")
-    parser.add_argument("-level", help="the KO level to use [%(default)s]", choices=[1, 2, 3], type=int, default=2)
-    parser.add_argument("-out", help="path to write the new table", default="ko_collapsed.tab")
+    parser.add_argument("-level", help="one or more KO levels to use [%(default)s]", choices=[1, 2, 3], type=int, nargs="+", default=[2])
+    parser.add_argument("-out", help="path to write the new table (with several levels, '.level<N>' is added before the extension)", default="ko_collapsed.tab")
 
 
     args = parser.parse_args()
 
-    ko_to_function = map_ko_to_function(args.ko_metadata, args.level)
-    collapse_kos(args.table, ko_to_function, args.orient, args.out)
+    levels = sorted(set(args.level))
+
+    hierarchy = KOHierarchy.load(args.ko_metadata)
+    ko_to_functions = {level: hierarchy.ko_to_pathways(level) for level in levels}
+    collapse_kos(args.table, ko_to_functions, args.orient, level_paths(args.out, levels))
@@ -1,7 +1,7 @@
 
 import argparse
 import pandas
-from puppetcrust import trait_table
+from puppetcrust import trait_table, tracing
 
 parser = argparse.ArgumentParser(description="Compares two trait tables using a given metric")
 parser.add_argument("-tab1", help="the trait table to use for table 1. This is the primary table", required=True)
@@ -9,9 +9,14 @@ parser.add_argument("-tab2", help="the table to compare to", required=True)
 parser.add_argument("-to_compare", help="a file with a list of names to compare", default=None)
 parser.add_argument("-metric", help="the metric to use [%(default)s]", choices=["disimilarity", "spearman"], default="disimilarity")
 parser.add_argument("-out", help="file to write the results [%(default)s]", default="compare_two_tables_output.tab")
+parser.add_argument("-cache", help="reuse (or write) a binary cache of each table next to it", action="store_true")
+parser.add_argument("-processes", help="number of processes to use for parsing the tables [%(default)s]", type=int, default=1)
+tracing.add_arguments(parser)
 
 args = parser.parse_args()
 
+tracing.enable_from_args(args)
+
 if args.to_compare:
     to_compare = []
     with open(args.to_compare, 'r') as IN:
@@ -20,7 +25,10 @@ if args.to_compare:
 else:
     to_compare = None
 
-results = trait_table.TraitTableManager.compare_two_tables(args.tab1, args.tab2, to_compare, args.metric)
+ttm1 = trait_table.TraitTableManager(args.tab1, cache=args.cache, processes=args.processes)
+ttm2 = trait_table.TraitTableManager(args.tab2, cache=args.cache, processes=args.processes)
+
+results = trait_table.TraitTableManager.compare_two_tables(ttm1, ttm2, to_compare, args.metric)
 
 df = pandas.DataFrame.from_dict(results, orient="index")
 
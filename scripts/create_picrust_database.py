@@ -1,26 +1,40 @@
 
 import argparse
 
-from puppetcrust import database
+from puppetcrust import database, tracing
 
 parser = argparse.ArgumentParser(description="Filters a PICRUSt table to match a marker FASTA file. Can accept multiple tables or FASTA files and optionally selectively include/exclude genome names. Outputs a new FASTA file and trait table beginning with the string supplied to -prefix")
-parser.add_argument("-fasta", help="one or more marker FASTA files. Header should be genome name", nargs="+", required=True)
-parser.add_argument("-traits", help="one or more trait tables. First column should be genome names. Tables should all have the same traits", nargs="+", required=True)
+parser.add_argument("-fasta", help="one or more marker FASTA files. Header should be genome name", nargs="+")
+parser.add_argument("-traits", help="one or more trait tables. First column should be genome names. Tables should all have the same traits", nargs="+")
+parser.add_argument("-catalog", help="build the database from a genome catalog (see build_genome_catalog.py) instead of -fasta and -traits")
 parser.add_argument("-prefix", help="prefixx for the new table and markers file. [%(default)s]", default="filtered")
 parser.add_argument("-subset", help="file of targeted genome names (default = to keep)")
 parser.add_argument("-inverse", help="remove the targeted sequences", action="store_true")
+parser.add_argument("-update", help="append the new genomes in -fasta and -traits to the database already at -prefix instead of making a new one", action="store_true")
+parser.add_argument("-cache", help="reuse (or write) a binary cache of each trait table next to it", action="store_true")
+parser.add_argument("-processes", help="number of FASTA files to index at once [%(default)s]", type=int, default=1)
+tracing.add_arguments(parser)
 
 
 args = parser.parse_args()
 
-dbm = database.DatabaseManager()
+tracing.enable_from_args(args)
+
+if not args.catalog and not (args.fasta and args.traits):
+    parser.error("-fasta and -traits are required unless -catalog is given")
+
+if args.catalog and args.update:
+    parser.error("-update can't be used with -catalog")
+
+dbm = database.DatabaseManager(cache=args.cache, processes=args.processes)
 
 # add the data files to the manager
-for f in args.fasta:
-    dbm.add_fasta(f)
+if not args.catalog:
+    for f in args.fasta:
+        dbm.add_fasta(f)
 
-for t in args.traits:
-    dbm.add_trait_table(t)
+    for t in args.traits:
+        dbm.add_trait_table(t)
 
 # read in a list of genome names if given
 if args.subset:
@@ -31,4 +45,12 @@ if args.subset:
 else:
     subset = []
 
-dbm.generate_database(args.prefix, subset=subset, inverse=args.inverse, verbose=True)
+if args.update:
+    if subset:
+        parser.error("-subset can't be used with -update")
+
+    dbm.update_database(args.prefix, verbose=True)
+elif args.catalog:
+    dbm.generate_from_catalog(args.catalog, args.prefix, subset=subset, inverse=args.inverse, verbose=True)
+else:
+    dbm.generate_database(args.prefix, subset=subset, inverse=args.inverse, verbose=True)
@@ -1,6 +1,11 @@
 
+from __future__ import division
+
 import argparse
 import os
+import multiprocessing
+
+import numpy
 
 def parse_ko_metadata(metadata_f):
     """ Parses the ko metadata file and returns a list of KOs """
@@ -17,9 +22,15 @@ def parse_ko_metadata(metadata_f):
     return sorted(kos)
 
 
-def count_KOs(ko_table_f, ko_list):
-    """ Parses a JGI KO table and counts KOs on the list """ 
-    ko_counts = {k: 0 for k in ko_list}
+def count_KOs(ko_table_f, ko_index):
+    """
+    Parses a JGI KO table and counts KOs in ko_index (a dict of KO: position).
+
+    Returns (counts, found, not_in_list) where counts is an array of the counts by position, found marks
+    the KOs that were in the table and not_in_list is the number of KOs in the table that weren't in ko_index.
+    """
+    counts = numpy.zeros(len(ko_index), dtype=numpy.float64)
+    found = numpy.zeros(len(ko_index), dtype=bool)
     ko_not_in_list = 0
     with open(ko_table_f, 'r') as IN:
         for line in IN:
@@ -28,53 +39,91 @@ def count_KOs(ko_table_f, ko_list):
                 continue
 
             elems = line.rstrip().split("\t")
-            
-            ko = elems[0]
-            try:
-                count = elems[-1]
-            except IndexError:
-                print((line,))
-                sys.exit()
-        
+
             # strip the "KO:" off the ko name
-            ko = ko[3:]
+            ko = elems[0][3:]
+            count = elems[-1]
 
             try:
-                ko_counts[ko] = float(count)
+                indx = ko_index[ko]
             except KeyError:
                 ko_not_in_list += 1
+                continue
 
-    print("{} KOs not in the ko_list.".format(ko_not_in_list))
-    return ko_counts
+            counts[indx] = float(count)
+            found[indx] = True
 
+    return counts, found, ko_not_in_list
 
-def main(args):
-    ko_list = parse_ko_metadata(args.ko_metadata)
-   
-    with open(args.out, 'w') as OUT:
-        OUT.write("\t".join(["OTU_IDs"] + ko_list) + "\n")
 
-        for ko_table in args.ko:
-            name = os.path.splitext(os.path.basename(ko_table))[0]
+def format_row(name, counts, found):
+    """ Returns the trait table line for a genome. KOs that weren't in its table are written as '0' and the rest as floats """
+    values = counts.tolist()
+    return "\t".join([name] + [str(values[indx]) if hit else "0" for indx, hit in enumerate(found.tolist())]) + "\n"
 
-            ko_counts = count_KOs(ko_table, ko_list)
 
-            # count the number of 
-            ko_not_counted = list(ko_counts.values()).count(0)
+# set in each worker by _init_worker so the KO index is only sent once per process
+_ko_index = None
 
-            print("{} KOs not found in genome.".format(ko_not_counted))
-            print("{} KOs found in the genome.".format(len(list(ko_counts.values())) - ko_not_counted))
-            print("")
+def _init_worker(ko_index):
+    global _ko_index
+    _ko_index = ko_index
 
-            to_write = [name]
-            [to_write.append(str(ko_counts[ko])) for ko in ko_list]
-            OUT.write("\t".join(to_write) + "\n")
+
+def _convert(ko_table):
+    """ Returns (trait table line, KOs found, KOs not in the list) for a JGI KO table """
+    name = os.path.splitext(os.path.basename(ko_table))[0]
+
+    counts, found, ko_not_in_list = count_KOs(ko_table, _ko_index)
+
+    # KOs with a count of 0 weren't found in the genome
+    return format_row(name, counts, found), int(numpy.count_nonzero(counts)), ko_not_in_list
+
+
+def main(args):
+    ko_list = parse_ko_metadata(args.ko_metadata)
+    ko_index = {ko: indx for indx, ko in enumerate(ko_list)}
+
+    # rows are written in the order of args.ko no matter which process finishes first
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes, _init_worker, (ko_index,))
+        rows = pool.imap(_convert, args.ko, chunksize=max(1, len(args.ko) // (args.processes * 16)))
+    else:
+        pool = None
+        _init_worker(ko_index)
+        rows = (_convert(ko_table) for ko_table in args.ko)
+
+    genomes = 0
+    found_per_genome = []
+    not_in_list = 0
+    try:
+        with open(args.out, 'w') as OUT:
+            OUT.write("\t".join(["OTU_IDs"] + ko_list) + "\n")
+
+            for line, found, ko_not_in_list in rows:
+                OUT.write(line)
+
+                genomes += 1
+                found_per_genome.append(found)
+                not_in_list += ko_not_in_list
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print("Converted {} genomes.".format(genomes))
+    print("{} KOs in the tables were not in the ko_list.".format(not_in_list))
+    if found_per_genome:
+        print("KOs found per genome: mean {:.1f}, min {}, max {} (of {}).".format(
+            sum(found_per_genome) / len(found_per_genome), min(found_per_genome), max(found_per_genome), len(ko_list)))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Converts JGI's KO table into a PICRUSt trait table")
     parser.add_argument("-ko", help="one or more JGI KO tables", nargs="+")
     parser.add_argument("-ko_metadata", help="the KO metadata table from the PICRUSt deconstructed files", required=True)
     parser.add_argument("-out", help="output path for the trait table", default="trait_table.tab")
+    parser.add_argument("-processes", help="number of KO tables to parse at once [%(default)s]", type=int, default=1)
 
     args = parser.parse_args()
 
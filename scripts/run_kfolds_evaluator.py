@@ -1,12 +1,11 @@
 
 import argparse
-from Bio import Phylo
 import random
 import os
 import pandas
 import logging
 
-from puppetcrust import trait_table, executer
+from puppetcrust import trait_table, executer, tracing, newick
 
 from matplotlib import rcParams
 rcParams.update({'figure.autolayout': True})
@@ -20,15 +19,62 @@ def _check_and_mkdir(path):
         os.mkdir(path)
 
 
+def partition_genomes(genomes, k, seed=None):
+    """
+    Randomly splits genomes into k groups. Returns a list of the groups (lists of genome names).
+
+    The genomes are shuffled once and sliced so each genome lands in exactly one group. The first
+    len(genomes) % k groups get one extra genome. The same seed always gives the same groups (None
+    uses a random seed).
+    """
+    if k < 1:
+        raise ValueError("k must be at least 1.")
+
+    genomes = list(genomes)
+    random.Random(seed).shuffle(genomes)
+
+    # calculate the number of genomes per group, adding the remainder to the first groups
+    genomes_per_group, remainder = divmod(len(genomes), k)
+
+    groups = []
+    start = 0
+    for group in range(k):
+        count = genomes_per_group + 1 if group < remainder else genomes_per_group
+        groups.append(genomes[start:start + count])
+        start += count
+
+    return groups
+
+
+@tracing.traced("write_ref_traits")
+def write_ref_traits(ttm, partitions):
+    """ Writes the reference traits of many partitions (all the traits except each one's genomes) reading the table once """
+    ttm.write_subsets([(p.ref_traits_f, p.genomes) for p in partitions], remove=True)
+
+
+def bootstrap_seed(seed, bootstrap):
+    """ Returns the seed for one bootstrap iteration so each is different but repeatable (None if seed is None) """
+    if seed is None:
+        return None
+
+    return seed * 1000003 + bootstrap
+
+
 
 class BootStrapper(object):
     """ Bundles the data and methods required for a bootstrapped experiment """
     
-    def __init__(self, tree, traits, k, work_dir, to_test=None):
+    def __init__(self, tree, traits, k, work_dir, to_test=None, cache=False, processes=1, array=False, seed=None):
         self.tree_f = tree
         self.traits_f = traits
         self.k = k
         self.work_dir = work_dir
+
+        # each iteration's partitions are seeded from this so runs can be repeated (None is random)
+        self.seed = seed
+
+        # submit all the partitions of the run as one job array
+        self.array = array
         
         # make work_dir if it doesn't exist
         _check_and_mkdir(self.work_dir)
@@ -43,6 +89,9 @@ class BootStrapper(object):
                     self.to_test.append(line.strip())
                     
 
+        # shared by all the KFolders so the observed table is only loaded once
+        self.ttm = trait_table.TraitTableManager(self.traits_f, cache=cache, processes=processes)
+
         # init for later use
         self.kfolds = []
 
@@ -50,15 +99,32 @@ class BootStrapper(object):
 
         LOG.info("Beginning bootstraping. Iterations={}".format(str(bootstrap)))
 
-        # make all the partitions and start running PICRUSt
+        # make all the partitions, then write all their reference tables in one pass and start running PICRUSt
+        new_partitions = []
         for job in range(bootstrap):
             job_dir = self.work_dir + "/" + "kfolds" + str(job)
         
-            kfolder = KFolder(tree=self.tree_f, traits=self.traits_f, work_dir=job_dir)
-            kfolder.make_partitions(k=self.k, to_test=self.to_test)
+            kfolder = KFolder(tree=self.tree_f, traits=self.ttm, work_dir=job_dir, defer_jobs=self.array)
+            new_partitions.extend(kfolder.make_partitions(k=self.k, to_test=self.to_test, seed=bootstrap_seed(self.seed, job), run=False))
             self.kfolds.append(kfolder)
 
-        # wait for them all to complete and process the results
+        if new_partitions:
+            write_ref_traits(self.ttm, new_partitions)
+            for partition in new_partitions:
+                partition.run_picrust()
+
+        if self.array:
+            pending = [p for kfolder in self.kfolds for p in kfolder.pending]
+            if pending:
+                job_name = executer.PicrustExecuter.submit_array([(p.picrust_command, p.work_dir) for p in pending], self.work_dir)
+                for p in pending:
+                    p.job_name = job_name
+
+                LOG.info("Submitted {} partitions as job array '{}'.".format(len(pending), job_name))
+
+        # wait for them all to complete (checking all the jobs together) and process the results
+        executer.PicrustExecuter.wait_for_jobs([name for kfolder in self.kfolds for name in kfolder.job_names()])
+
         pandas_dict = {}
         for indx, kfolder in enumerate(self.kfolds):
             LOG.info("Processing iteration {}...".format(indx))
@@ -84,11 +150,20 @@ class BootStrapper(object):
 class KFolder(object):
     """ Bundles the data and methods required for a single k-fold experiment """
     
-    def __init__(self, tree, traits, work_dir):
+    def __init__(self, tree, traits, work_dir, defer_jobs=False):
         self.tree_f = tree
-        self.ttm = trait_table.TraitTableManager(traits)
         self.work_dir = work_dir
 
+        # if True, partitions only set up their PICRUSt jobs and add themselves to pending for whoever submits them
+        self.defer_jobs = defer_jobs
+        self.pending = []
+
+        # traits can be a manager so bootstraps can share one loaded table
+        if isinstance(traits, trait_table.TraitTableManager):
+            self.ttm = traits
+        else:
+            self.ttm = trait_table.TraitTableManager(traits)
+
         # simple check subject to race condition, I should rewrite using a try-except
         if not os.path.isdir(work_dir):
             os.mkdir(work_dir)
@@ -100,8 +175,15 @@ class KFolder(object):
         LOG.info("Initialized K-Folds experiment in directory '{}'.".format(work_dir))
 
 
-    def make_partitions(self, k, to_test=None, seed=0):
-        """ Randomly makes partitions of the traits table """
+    @tracing.traced("make_partitions")
+    def make_partitions(self, k, to_test=None, seed=None, run=True):
+        """
+        Randomly makes partitions of the traits table. The same seed gives the same partitions (None is random).
+
+        Unless run is False, the reference tables of the partitions are written and PICRUSt is started for
+        them; otherwise that is left to the caller (see run_partitions). Returns the new partitions (none if
+        they were loaded from the work_dir).
+        """
         
         # try to load partitions
         for group in range(k):
@@ -117,49 +199,55 @@ class KFolder(object):
                     raise ValueError("Successfully loaded some partitions but failed to load others. Refusing to run analysis in this directory. Please delete the output directory or select a new location.")
         else:
             LOG.info("Successfully loaded partitions.")
-            return
+            return []
 
         # get genomes from the external nodes of the tree
-        # comments_are_confidence allows me to keep the digit only node names
-        # this parser tries to conv names to confidence otherwise
-        tree = Phylo.read(self.tree_f, "newick", comments_are_confidence=True)
-        genomes = [node.name for node in tree.get_terminals()]
+        # the tips are only read once per tree file, so bootstraps share them
+        genomes = newick.load_tips(self.tree_f)
         
         # make sure all the genomes in to_test are in the tree and then use only to test genomes for the rest
         if to_test:
+            in_tree = set(genomes)
             for genome in to_test:
-                if not genome in genomes:
+                if not genome in in_tree:
                     raise ValueError("Genome in test set '{}' is not in the tree. Aborting.".format(genome))
             genomes = to_test
 
+        # make random groups
+        partitions = []
+        for group, sample in enumerate(partition_genomes(genomes, k, seed)):
+            partition = Partition(sample, self, self.work_dir + "/" + "partition{}".format(str((group))))
+            partition.write_test_genomes()
+            partitions.append(partition)
+            self.partitions.append(partition)
+        
+            LOG.info("Created partition {} with n={}.".format(str(group), str(len(sample))))
 
-        # calculate the number of genomes per group
-        genomes_per_group = int(len(genomes) / k)
-        remainder = len(genomes) % k
+        if run:
+            self.run_partitions(partitions)
 
+        return partitions
 
-        # make random groups
-        for group in range(k):
-            # add remainder to the first groups
-            if remainder:
-                remainder -= 1
-                count = genomes_per_group + 1
-            else:
-                count = genomes_per_group
+    def run_partitions(self, partitions):
+        """ Writes the reference tables of partitions in one pass over the traits and starts PICRUSt for each """
+        write_ref_traits(self.ttm, partitions)
 
-            sample = random.sample(genomes, count)
+        for partition in partitions:
+            partition.run_picrust()
 
-            # remove the sample from the original
-            genomes = [g for g in genomes if g not in sample]
+    def job_names(self):
+        """ Returns the names of the jobs submitted for the partitions (partitions in a job array share one) """
+        names = []
+        for p in self.partitions:
+            if p.job_name is not None and p.job_name not in names:
+                names.append(p.job_name)
 
-            partition = Partition(sample, self, self.work_dir + "/" + "partition{}".format(str((group))))
-            partition.run()
-            self.partitions.append(partition)
-        
-            LOG.info("Created partition {} with n={}.".format(str(group), str(count)))
+        return names
 
     def analyze(self, metric):
         # wait for all to finish and then process 
+        executer.PicrustExecuter.wait_for_jobs(self.job_names())
+
         for p in self.partitions:
             try:
                 p.parse_results(metric)
@@ -189,6 +277,7 @@ class Partition(object):
 
         # attribs to be set later
         self.job_name = None
+        self.picrust_command = None
         self.pred_traits_f = None
         self.results = {g: None for g in self.genomes}
 
@@ -233,7 +322,7 @@ class Partition(object):
     def write_ref_traits(self):
         """ Write all the traits except the partition """
 
-        self.kfolder.ttm.write_subset(self.ref_traits_f, self.genomes, remove=True)
+        write_ref_traits(self.kfolder.ttm, [self])
 
     def write_test_genomes(self):
         """ Write a list of genome names being tested """
@@ -243,25 +332,33 @@ class Partition(object):
                 OUT.write(g + "\n")
 
     def run_picrust(self):
-        self.job_name, self.pred_traits_f = executer.PicrustExecuter.predict_traits_wf(
-                tree=self.kfolder.tree_f, trait_table=self.ref_traits_f, limit=self.test_genomes_f, base_dir=self.work_dir)
+        if self.kfolder.defer_jobs:
+            self.picrust_command, base_dir, self.pred_traits_f = executer.PicrustExecuter.predict_traits_wf_command(
+                    tree=self.kfolder.tree_f, trait_table=self.ref_traits_f, limit=self.test_genomes_f, base_dir=self.work_dir)
+            self.kfolder.pending.append(self)
+        else:
+            self.job_name, self.pred_traits_f = executer.PicrustExecuter.predict_traits_wf(
+                    tree=self.kfolder.tree_f, trait_table=self.ref_traits_f, limit=self.test_genomes_f, base_dir=self.work_dir)
 
+    @tracing.traced("parse_results", lambda self, metric: {"partition": self.work_dir})
     def parse_results(self, metric):
-        obs_ttm = self.kfolder.ttm
-        pred_ttm = trait_table.TraitTableManager(self.pred_traits_f)
+        """ Scores all the test genomes at once. Each table is only read once (the observed one is shared by the KFolder) """
+        obs_matrix = self.kfolder.ttm.load()
+        pred_matrix = trait_table.TraitTableManager(self.pred_traits_f).load()
 
-        obs_entries = [entry for entry in obs_ttm if entry.name in self.genomes]
-
-        for obs in obs_entries:
-            for pred in pred_ttm:
-                if obs.name == pred.name:
-                    # if changed, make sure to change the best column (right now it assumes > is better)
-                    self.results[obs.name] = obs.compare(pred, metric=metric)
+        scores = obs_matrix.compare_rows(pred_matrix, metric, self.genomes)
 
         # make sure all genomes were found
-        for genome in self.results:
-            if self.results[genome] is None:
-                raise ValueError("Calculation failed for genome '{}'".format(genome))
+        if len(scores) != len(set(self.genomes)):
+            not_obs = [g for g in self.genomes if g not in obs_matrix]
+            not_pred = [g for g in self.genomes if g not in pred_matrix]
+
+            raise ValueError("Calculation failed for {} genome(s) in '{}'. Not in observed table: {}. Not in predicted table: {}.".format(
+                len(set(not_obs + not_pred)), self.work_dir, ", ".join(not_obs) or "none", ", ".join(not_pred) or "none"))
+
+        # if changed, make sure to change the best column (right now it assumes > is better)
+        for genome in self.genomes:
+            self.results[genome] = scores[genome]
 
 
 if __name__ == "__main__":
@@ -274,10 +371,29 @@ if __name__ == "__main__":
     parser.add_argument("-bootstrap", help="number of iterations. Default=%(default)s", type=int, default=1)
     parser.add_argument("-metric", help="the metric to use for accuracy", choices=["spearman", "disimilarity"], default="spearman")
     parser.add_argument("-outdir", help="directory to store the output. Default=%(default)s", default=os.getcwd())
+    parser.add_argument("-cache", help="reuse (or write) a binary cache of the trait table next to it", action="store_true")
+    parser.add_argument("-processes", help="number of processes to use for parsing the trait table. Default=%(default)s", type=int, default=1)
+    parser.add_argument("-backend", help="how to run the PICRUSt jobs. Default=%(default)s", choices=sorted(executer.BACKENDS), default="lsf")
+    parser.add_argument("-jobs", help="max number of jobs to run at once with the local backend. Default=number of CPUs", type=int, default=None)
+    parser.add_argument("-step_cache", help="directory to cache the outputs of trait prediction steps in so identical reruns are skipped", default=None)
+    parser.add_argument("-step_cache_gb", help="max size of the step cache in GB. Default=no limit", type=float, default=None)
+    parser.add_argument("-array", help="submit all the partitions as a single job array instead of one job each", action="store_true")
+    parser.add_argument("-seed", help="random seed for the partitions so a run can be repeated. Default=random", type=int, default=None)
+    tracing.add_arguments(parser)
 
     args = parser.parse_args()
 
     LOG.setLevel(logging.INFO)
+    tracing.enable_from_args(args)
+
+    if args.backend == "local":
+        executer.PicrustExecuter.set_backend(executer.LocalBackend(max_jobs=args.jobs))
+    else:
+        executer.PicrustExecuter.set_backend(args.backend)
+
+    if args.step_cache:
+        max_bytes = int(args.step_cache_gb * 1024 ** 3) if args.step_cache_gb else None
+        executer.PicrustExecuter.set_step_cache(args.step_cache, max_bytes)
 
-    bstrap = BootStrapper(args.tree, args.traits, args.k, args.outdir, to_test=args.test)
+    bstrap = BootStrapper(args.tree, args.traits, args.k, args.outdir, to_test=args.test, cache=args.cache, processes=args.processes, array=args.array, seed=args.seed)
     bstrap.run(args.bootstrap, args.metric)
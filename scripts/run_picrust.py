@@ -2,7 +2,7 @@
 import argparse
 import os
 
-from puppetcrust import executer, trait_table
+from puppetcrust import executer, trait_table, tracing
 
 
 def predict_traits(tree, ref_traits, type, base_dir, subset=None):
@@ -11,12 +11,21 @@ def predict_traits(tree, ref_traits, type, base_dir, subset=None):
     return executer.PicrustExecuter.predict_traits_wf(tree, ref_traits, type=type, base_dir=base_dir, limit=subset)
 
 
-def predict_metagenome(otu_table, copy_numbers, trait_table, base_dir):
+def predict_metagenome(otu_table, copy_numbers, trait_table, base_dir, in_process=False):
     
-    return executer.PicrustExecuter.predict_metagenome(otu_table, copy_numbers, trait_table, base_dir)
+    return executer.PicrustExecuter.predict_metagenome(otu_table, copy_numbers, trait_table, base_dir, in_process=in_process)
 
 def main(args):
 
+    if args.backend == "local":
+        executer.PicrustExecuter.set_backend(executer.LocalBackend(max_jobs=args.jobs))
+    else:
+        executer.PicrustExecuter.set_backend(args.backend)
+
+    if args.step_cache:
+        max_bytes = int(args.step_cache_gb * 1024 ** 3) if args.step_cache_gb else None
+        executer.PicrustExecuter.set_step_cache(args.step_cache, max_bytes)
+
     # set up the output dir if needed
     if not os.path.isdir(args.out):
         os.mkdir(args.out)
@@ -37,15 +46,16 @@ def main(args):
                     jobs.append(job_name)
                     args.marker_counts = new_markers
 
-        for job in jobs:
-            executer.PicrustExecuter.wait_for_job(job)
+        executer.PicrustExecuter.wait_for_jobs(jobs)
 
         print("Trait prediction complete.")
 
     if args.wf == "predict_metagenome" or args.wf == "both":
-        job_name, predicted_metagenome = predict_metagenome(args.otu_table, args.marker_counts, args.traits, args.out)
+        job_name, predicted_metagenome = predict_metagenome(args.otu_table, args.marker_counts, args.traits, args.out, args.in_process)
 
-        executer.PicrustExecuter.wait_for_job(job_name)
+        # in process predictions are already done
+        if job_name is not None:
+            executer.PicrustExecuter.wait_for_job(job_name)
 
         print("Predicted metagenome stored as {}".format(predicted_metagenome))
 
@@ -60,6 +70,13 @@ if __name__ == "__main__":
     parser.add_argument("-marker_counts", help="counts of marker genes")
     parser.add_argument("-otu_table", help="otu table to use for metagenome prediction")
     parser.add_argument("-out", help="directory for output", default=os.getcwd())
+    parser.add_argument("-backend", help="how to run the PICRUSt jobs [%(default)s]", choices=sorted(executer.BACKENDS), default="lsf")
+    parser.add_argument("-jobs", help="max number of jobs to run at once with the local backend [number of CPUs]", type=int, default=None)
+    parser.add_argument("-step_cache", help="directory to cache the outputs of trait prediction steps in so identical reruns are skipped", default=None)
+    parser.add_argument("-step_cache_gb", help="max size of the step cache in GB [no limit]", type=float, default=None)
+    parser.add_argument("-in_process", help="normalize and predict the metagenome here with SciPy instead of submitting PICRUSt's scripts as a job", action="store_true")
+    tracing.add_arguments(parser)
     args = parser.parse_args()
 
+    tracing.enable_from_args(args)
     main(args)
@@ -0,0 +1,61 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+import importlib.util
+
+import pandas
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _load_script(name):
+    """ Imports one of the scripts in scripts/ as a module """
+    path = os.path.join(ROOT_DIR, "scripts", name + ".py")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+collapse = _load_script("collapse_ko_by_function")
+
+
+KO_TO_FUNCTIONAL = {
+        "K00001": ["Glycolysis"],
+        "K00002": ["Glycolysis", "Pyruvate metabolism"]
+        }
+
+
+class TestCollapseKOs(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.out_f = os.path.join(self.work_dir, "collapsed.tab")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_string_column_is_skipped(self):
+        table_f = os.path.join(self.work_dir, "kos.tab")
+        with open(table_f, 'w') as OUT:
+            OUT.write("ko\tS1\tS2\tdescription\n")
+            OUT.write("K00001\t1\t2\talcohol dehydrogenase\n")
+            OUT.write("K00002\t3\t4\talcohol dehydrogenase (NADP+)\n")
+
+        with self.assertLogs(collapse.LOG, "WARNING") as logs:
+            collapse.collapse_kos(table_f, {2: KO_TO_FUNCTIONAL}, "rows", {2: self.out_f})
+
+        self.assertIn("description", "\n".join(logs.output))
+
+        collapsed = pandas.read_csv(self.out_f, sep="\t", index_col=0)
+        self.assertEqual(list(collapsed.columns), ["S1", "S2"])
+        self.assertEqual(collapsed.loc["Glycolysis"].tolist(), [4, 6])
+        self.assertEqual(collapsed.loc["Pyruvate metabolism"].tolist(), [3, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
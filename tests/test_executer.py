@@ -0,0 +1,61 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from puppetcrust import executer
+
+
+OTU_TABLE = """# Constructed from biom file
+#OTU ID\tS1\tS2\tS3\tS4
+otu1\t1.0\t0.0\t2.0\t0.0
+otu2\t0.0\t3.0\t0.0\t1.0
+otu3\t5.0\t5.0\t5.0\t5.0
+"""
+
+TRAIT_TABLE = """genome\tK00001\tK00002
+otu1\t1\t0
+otu3\t2\t1
+"""
+
+
+class TestFilterOTUs(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+        self.otu_f = os.path.join(self.work_dir, "otu_table.tab")
+        with open(self.otu_f, 'w') as OUT:
+            OUT.write(OTU_TABLE)
+
+        self.traits_f = os.path.join(self.work_dir, "traits.tab")
+        with open(self.traits_f, 'w') as OUT:
+            OUT.write(TRAIT_TABLE)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_filter_otus(self):
+        out_f = os.path.join(self.work_dir, "filtered.tab")
+        executer.PicrustExecuter._filter_otus(self.otu_f, self.traits_f, out_f)
+
+        with open(out_f, 'r') as IN:
+            lines = IN.readlines()
+
+        self.assertEqual([line.split("\t", 1)[0] for line in lines], ["# Constructed from biom file\n", "#OTU ID", "otu1", "otu3"])
+
+    @unittest.skipIf(executer.biom is None, "biom can't be imported")
+    def test_filter_otus_to_biom(self):
+        out_f = os.path.join(self.work_dir, "filtered.biom")
+        executer.PicrustExecuter._filter_otus_to_biom(self.otu_f, self.traits_f, out_f)
+
+        table = executer.biom.load_table(out_f)
+
+        self.assertEqual(list(table.ids(axis="observation")), ["otu1", "otu3"])
+        self.assertEqual(list(table.ids(axis="sample")), ["S1", "S2", "S3", "S4"])
+        self.assertEqual(table.data("otu3", axis="observation").tolist(), [5.0, 5.0, 5.0, 5.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from puppetcrust.step_cache import StepCache
+
+
+class TestStepCache(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache = StepCache(os.path.join(self.work_dir, "cache"))
+        self.out_f = os.path.join(self.work_dir, "out.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_rerun_in_place_keeps_entry(self):
+        # the second step rewrites the output in place, which used to rewrite the first step's entry too
+        self.assertEqual(self.cache.run("x", [self.out_f], "echo first > {}".format(self.out_f)), 0)
+        self.assertEqual(self.cache.run("y", [self.out_f], "echo second > {}".format(self.out_f)), 0)
+
+        self.cache.run("x", [self.out_f], "false")
+        with open(self.out_f, 'r') as IN:
+            self.assertEqual(IN.read(), "first\n")
+
+        self.cache.run("y", [self.out_f], "false")
+        with open(self.out_f, 'r') as IN:
+            self.assertEqual(IN.read(), "second\n")
+
+    def test_store_keeps_published_entry(self):
+        with open(self.out_f, 'w') as OUT:
+            OUT.write("first\n")
+        self.cache.store("x", [self.out_f])
+
+        # a second store of the same key (like a concurrent job) doesn't replace the entry
+        os.remove(self.out_f)
+        with open(self.out_f, 'w') as OUT:
+            OUT.write("other\n")
+        self.cache.store("x", [self.out_f])
+
+        self.cache.fetch("x", [self.out_f])
+        with open(self.out_f, 'r') as IN:
+            self.assertEqual(IN.read(), "first\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
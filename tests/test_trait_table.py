@@ -0,0 +1,79 @@
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from puppetcrust import trait_table
+
+
+def write_table(path, genomes, traits, values, seed):
+    """ Writes a mostly zero integer trait table with counts drawn from values """
+    rng = random.Random(seed)
+    with open(path, 'w') as OUT:
+        OUT.write("\t".join(["genome"] + ["K{:05d}".format(indx) for indx in range(traits)]) + "\n")
+        for genome in range(genomes):
+            row = [str(rng.choice(values)) if rng.random() < 0.2 else "0" for _ in range(traits)]
+            OUT.write("\t".join(["g{}".format(genome)] + row) + "\n")
+
+
+@unittest.skipIf(trait_table.sparse is None, "SciPy can't be imported")
+class TestSparseCompare(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+        self.tab1 = os.path.join(self.work_dir, "tab1.tab")
+        self.tab2 = os.path.join(self.work_dir, "tab2.tab")
+        write_table(self.tab1, 20, 30, [1, 40], seed=1)
+        write_table(self.tab2, 20, 30, [1, 40], seed=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_sparse_disimilarity_matches_dense(self):
+        dense1 = trait_table.TraitTableMatrix.from_file(self.tab1, storage="dense")
+        dense2 = trait_table.TraitTableMatrix.from_file(self.tab2, storage="dense")
+        sparse1 = trait_table.TraitTableMatrix.from_file(self.tab1, storage="sparse")
+        sparse2 = trait_table.TraitTableMatrix.from_file(self.tab2, storage="sparse")
+
+        # the counts are narrowed to a small unsigned type, where differences would wrap
+        self.assertEqual(sparse1.values.dtype.kind, "u")
+
+        expected = dense1.compare_rows(dense2, "disimilarity")
+        scores = sparse1.compare_rows(sparse2, "disimilarity")
+
+        self.assertEqual(sorted(scores), sorted(expected))
+        for name in expected:
+            self.assertAlmostEqual(scores[name], expected[name])
+
+
+class TestIterChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+        self.table_f = os.path.join(self.work_dir, "table.tab")
+        write_table(self.table_f, 20, 30, [1, 40], seed=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_chunks_match_with_and_without_cache(self):
+        uncached = list(trait_table.TraitTableManager(self.table_f).iter_chunks(rows=8))
+
+        # the first run writes the cache and the second reads it
+        for _ in range(2):
+            cached = list(trait_table.TraitTableManager(self.table_f, cache=True).iter_chunks(rows=8))
+
+            self.assertEqual(len(cached), len(uncached))
+            for (names, values), (expected_names, expected) in zip(cached, uncached):
+                self.assertEqual(names, expected_names)
+                self.assertIs(type(values), type(expected))
+                self.assertEqual(values.dtype, expected.dtype)
+                self.assertEqual(values.tolist(), expected.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()